@@ -4,15 +4,17 @@ import random
 import json
 import os
 import os.path as osp
-import copy
 from utils.form import PairwiseForm
 from utils.pipeline import PairwisePipeline
+from conversation.session import SessionStore
 
 class ConversationForm(PairwiseForm):
     def __init__(
         self,
         model: PairwisePipeline,
         title: str,
+        max_sessions: int = 256,
+        session_ttl: float = 12 * 60 * 60,  # seconds since last access
     ):
         # Excluded 1 turn before and after
         # minimum = 1
@@ -40,9 +42,18 @@ class ConversationForm(PairwiseForm):
             "system_usage_instruction": self.__load_guidance("system_usage_instruction"),
             "end_of_tasks": self.__load_guidance("end_of_tasks"),
         }
-        self.user_temp = {}
-        self.user_data = {}
-        self.user_model = {}
+        self.data_path = "results"
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.sessions = SessionStore(
+            create_model=model.create_session,
+            max_sessions=self.max_sessions,
+            ttl=self.session_ttl,
+            spill_path=osp.join(self.data_path, "sessions"),
+        )
+        self.user_temp = self.sessions.view("temp")
+        self.user_data = self.sessions.view("data")
+        self.user_model = self.sessions.view("model")
         # self.data = {
         #     "mturk_worker_id": "N/A",
         #     "result": {
@@ -54,7 +65,6 @@ class ConversationForm(PairwiseForm):
         #         "usability_answer": list()
         #     }
         # }
-        self.data_path = "results"
         self.text_input_hint="If the microphone malfunctions, use text input."
         self.evaluation_check_msg = "Please complete all survey questions."
 
@@ -69,11 +79,11 @@ class ConversationForm(PairwiseForm):
         self.logger.addHandler(self.file_handler)
     
     def __init_user_data(self, mturk_worker_id: str) -> None:
-        self.user_temp[mturk_worker_id] = {
+        temp = {
             "situation_idx": 0,
             "scenario_count": 0,
         }
-        self.user_data[mturk_worker_id] = {
+        data = {
             "mturk_worker_id": mturk_worker_id,
             "result": {
                 "situation1": list(),
@@ -84,10 +94,25 @@ class ConversationForm(PairwiseForm):
                 "usability_answer": list(),
             },
         }
-        user_model = copy.deepcopy(self.model)
-        user_model.generate_model_1.reset()
-        user_model.generate_model_2.reset()
-        self.user_model[mturk_worker_id] = user_model
+        if mturk_worker_id in self.sessions and not self.user_temp[mturk_worker_id].get("submitted"):
+            # A returning worker resumes their live or spilled session at the current
+            # situation; the page starts with an empty chat, so its conversation restarts.
+            self.__restart_conversation(mturk_worker_id)
+            return
+        self.sessions.create(mturk_worker_id, temp, data)
+
+    def __restart_conversation(self, mturk_worker_id: str) -> None:
+        situation_idx = self.user_temp[mturk_worker_id]['situation_idx']
+        if situation_idx > 3:
+            return
+        self.user_temp[mturk_worker_id]['scenario_count'] = 0
+        if situation_idx <= 2:
+            self.user_data[mturk_worker_id]["result"][f"situation{situation_idx + 1}"].clear()
+        else:
+            self.user_data[mturk_worker_id]["result"]["freetalk"].clear()
+
+        self.user_model[mturk_worker_id].generate_model_1.reset()
+        self.user_model[mturk_worker_id].generate_model_2.reset()
 
     def _create_form(self) -> gr.Blocks:
         with gr.Blocks(css="#chatbot") as form:
@@ -299,7 +324,7 @@ class ConversationForm(PairwiseForm):
                 inputs=[id_input, save_id_button, skip_button,
                         situation_title, situation_description, chatbot],
                 outputs=[id_input, save_id_button, skip_button,
-                         situation_title, situation_description, chatbot, input_column],
+                         situation_title, situation_description, chatbot, input_column, last_row],
                 queue=False,
             )
             
@@ -567,12 +592,17 @@ class ConversationForm(PairwiseForm):
     
     def __save_id(self, id_input, save_id_button, skip_button, *args):
         if not id_input:
-            return (id_input, save_id_button, skip_button,) + tuple(args) + (gr.update(visible=False), )
+            return (id_input, save_id_button, skip_button,) + tuple(args) + (gr.update(visible=False), ) * 2
         # self.data[id_input]["mturk_worker_id"] = id_input
         self.__init_user_data(id_input)
+        # The page follows the (possibly resumed) session; after the free talk only the last question is left.
+        finished = self.user_temp[id_input]['situation_idx'] > 3
         return (gr.update(interactive=False), ) * 2 \
-                + (gr.update(visible=self.skip_btn_visible),) \
-                + (gr.update(visible=True),) * (len(args) + 1)
+                + (gr.update(visible=self.skip_btn_visible and not finished),) \
+                + (gr.update(visible=not finished),) \
+                + (gr.update(visible=not finished, value=self.__get_current_scenario(id_input)),) \
+                + (gr.update(visible=not finished, value=None),) \
+                + (gr.update(visible=not finished), gr.update(visible=finished))
     
     def __clear_audio(self, audio):
         if not audio:
@@ -588,9 +618,10 @@ class ConversationForm(PairwiseForm):
         assistant_message = dict()
         
         if self.user_temp[id_input]['situation_idx'] <= 2:
-            # if self.random_num == 0 1=base, 2=augmented
+            # if random_num == 0 1=base, 2=augmented
             # else 1=augmented, 2=base
-            if self.random_num == 0:
+            random_num = self.user_temp[id_input].get("random_num", 0)
+            if random_num == 0:
                 for i in range(0, 3):
                     all_questions[i] = f"base={all_questions[i]}"
                 for i in range(3, 6):
@@ -611,8 +642,8 @@ class ConversationForm(PairwiseForm):
             message1 = message1.replace("[Model 1]","").strip()
             message2 = message2.strip()
 
-            assistant_message['base_model'] = message1 if self.random_num == 0 else message2
-            assistant_message['augmented_model'] = message2 if self.random_num == 0 else message1
+            assistant_message['base_model'] = message1 if random_num == 0 else message2
+            assistant_message['augmented_model'] = message2 if random_num == 0 else message1
         else:
             message = chatbot[-1][1]
             assistant_message['augmented_model'] = message
@@ -641,42 +672,56 @@ class ConversationForm(PairwiseForm):
                 + (gr.update(value=description), gr.update(visible=True),) \
                 + (gr.update(value=None),) * len(args)
     
-    def __process(self, history, id_input):
+    async def __process(self, history, id_input):
         input = history[-1][0]
+        model = self.user_model[id_input]
+        # Runs on the event loop; network-bound model calls do not occupy a worker thread.
+        async def run(**kwargs):
+            if model.stream_output:
+                async for response in model.astream(**kwargs):
+                    yield response
+            else:
+                yield await model.arun(**kwargs)
 
         if isinstance(input, str):
-            response = self.user_model[id_input].fn(text_input=input)
+            responses = run(text_input=input)
         elif isinstance(input, tuple):
-            response = self.user_model[id_input].fn(audio_file=input[0])
+            responses = run(audio_file=input[0])
         else:
-            response = self.user_model[id_input].fn(
+            responses = run(
                 text_input=input,
                 forced_response="This type of input is not supported.",
             )
-        transcript, message, message2 = response
-        print(f"- User: {transcript}")
 
-        message = message.strip()
-        message2 = message2.strip()
-        self.random_num = random.randrange(2)
-        #speech_data = f"data:audio/wav;base64,{speech if self.random_num == 0 else speech2}"
-        #output = f"[Model 1]<br/><audio controls autoplay src=\"{speech_data}\" type=\"audio/wav\"></audio>"
-        if self.user_temp[id_input]['situation_idx'] <= 2:
-            output = "[Model 1]\n"
-            output += message if self.random_num == 0 else message2
-        
-            #speech_data = f"data:audio/wav;base64,{speech2 if self.random_num == 0 else speech}"
-            output += f"\n\n[Model 2]\n" #<br/><audio controls src=\"{speech_data}\" type=\"audio/wav\"></audio>"
-            output += message2 if self.random_num == 0 else message
+        # Per turn and per session: another participant's turn must not swap the labels mid-reply.
+        random_num = random.randrange(2)
+        self.user_temp[id_input]["random_num"] = random_num
+        async for response in responses:
+            transcript, message, message2 = response
+
+            message = message.strip()
+            message2 = message2.strip()
+            #speech_data = f"data:audio/wav;base64,{speech if random_num == 0 else speech2}"
+            #output = f"[Model 1]<br/><audio controls autoplay src=\"{speech_data}\" type=\"audio/wav\"></audio>"
+            if self.user_temp[id_input]['situation_idx'] <= 2:
+                output = "[Model 1]\n"
+                output += message if random_num == 0 else message2
+            
+                #speech_data = f"data:audio/wav;base64,{speech2 if random_num == 0 else speech}"
+                output += f"\n\n[Model 2]\n" #<br/><audio controls src=\"{speech_data}\" type=\"audio/wav\"></audio>"
+                output += message2 if random_num == 0 else message
+            else:
+                output = message2
+
+            history[-1] = (transcript, output)
+            yield history
 
-            print(f"- Assistant 1: {message if self.random_num == 0 else message2}")
-            print(f"- Assistant 2: {message2 if self.random_num == 0 else message}")
+        print(f"- User: {transcript}")
+        if self.user_temp[id_input]['situation_idx'] <= 2:
+            print(f"- Assistant 1: {message if random_num == 0 else message2}")
+            print(f"- Assistant 2: {message2 if random_num == 0 else message}")
         else:
-            output = message2
             print(f"- Our Assistant: {message2}")
-
-        history[-1] = (transcript, output)
-        return history
     
     def __reset(self, id_input):
         content = dict()
@@ -684,15 +729,8 @@ class ConversationForm(PairwiseForm):
         if self.user_temp[id_input]['situation_idx'] <= 2:
             content["situation_index"] = self.user_temp[id_input]['situation_idx']
         content['message'] = "The conversation history has been reset."
-        self.user_temp[id_input]['scenario_count'] = 0
         self.logger.info(f"HIT: {str(content)}")
-        if self.user_temp[id_input]['situation_idx'] <= 2:
-            self.user_data[id_input]["result"][f"situation{self.user_temp[id_input]['situation_idx'] + 1}"].clear()
-        else:
-            self.user_data[id_input]["result"][f"freetalk"].clear()
-
-        self.user_model[id_input].generate_model_1.reset()
-        self.user_model[id_input].generate_model_2.reset()
+        self.__restart_conversation(id_input)
 
         return (gr.update(value=None),) * 10 + (gr.update(visible=False),) * 4
     
@@ -733,9 +771,10 @@ class ConversationForm(PairwiseForm):
         assistant_message = dict()
 
         if self.user_temp[id_input]['situation_idx'] <= 2:
-            # if self.random_num == 0 1=base, 2=augmented
+            # if random_num == 0 1=base, 2=augmented
             # else 1=augmented, 2=base
-            if self.random_num == 0:
+            random_num = self.user_temp[id_input].get("random_num", 0)
+            if random_num == 0:
                 for i in range(0, 3):
                     all_questions[i] = f"base={all_questions[i]}"
                 for i in range(3, 6):
@@ -756,8 +795,8 @@ class ConversationForm(PairwiseForm):
             message1 = message1.replace("[Model 1]","").strip()
             message2 = message2.strip()
 
-            assistant_message['base_model'] = message1 if self.random_num == 0 else message2
-            assistant_message['augmented_model'] = message2 if self.random_num == 0 else message1
+            assistant_message['base_model'] = message1 if random_num == 0 else message2
+            assistant_message['augmented_model'] = message2 if random_num == 0 else message1
         else:
             message = chatbot[-1][1]
             assistant_message['augmented_model'] = message
@@ -824,6 +863,8 @@ class ConversationForm(PairwiseForm):
         
         self.user_temp[id_input]['situation_idx'] = 0
         self.user_temp[id_input]['scenario_count'] = 0
+        # The results are on disk; entering this ID again starts a new session.
+        self.user_temp[id_input]['submitted'] = True
         
         if len(args) == 1:
             return (gr.update(visible=False),) * 2 \
@@ -1,16 +1,128 @@
+import asyncio
 import os
 import os.path as osp
+import threading
 import time
 import json
 import typing
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from utils.model import Model
+from utils.model import Model, get_shared_model
 from models.palm.core import PaLM
-from conversation.retriever import BiEncoderRetriever
+from conversation.retriever import SummaryIndex, get_retriever
+from conversation.stages import StageGraph
+
+ERROR_RESPONSE = "Sorry, there was an error processing your request. Please try again, and if the error persists, reset the conversation and start over."
+
+_prompt_templates: dict[str, dict[str, str]] = {}
+
+# Memorization runs after the response is returned, shared by all sessions.
+_memorization_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memorization")
+def configure_memorization(max_workers: int) -> None:
+    # Memorizations submitted afterwards run on a pool of the new size.
+    global _memorization_executor
+    previous = _memorization_executor
+    _memorization_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="memorization")
+    previous.shutdown(wait=False)
+
+# Independent stages of a single turn run concurrently on this pool.
+_stage_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="stage")
 
 @dataclass
 class PromptConfig:
     remove_cot: bool = False
+    background_memorization: bool = True
+    incremental_memorization: bool = True
+    memorization_window: int = 2  # already memorized entries given as context
+    retriever_dtype: str = "float32"  # int8 or bfloat16 for faster CPU retrieval, float16 on CUDA
+    speculative_retrieval: bool = True  # overlap retrieval with extraction
+    mode: str = "chain"  # "chain" of stage prompts or a single "fused" prompt
+    fused_history_window: int = 6  # recent dialogue entries included in the fused prompt
+
+class Turn:
+    # One prompt of a session. An abandoned turn (timed out, or superseded by
+    # the next one) never writes its reply into the session.
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.abandoned = False
+        self.committed = False
+
+    def abandon(self) -> bool:
+        with self.lock:
+            if not self.committed:
+                self.abandoned = True
+            return self.abandoned
+
+    def commit(self, fn: typing.Callable[[], None]) -> bool:
+        with self.lock:
+            if self.abandoned:
+                return False
+            fn()
+            self.committed = True
+            return True
+
+class TurnFence:
+    # Starting a turn abandons one still running, so a stale reply cannot
+    # land after (or in the middle of) a newer turn.
+    def __init__(self) -> None:
+        self.turn: typing.Optional[Turn] = None
+
+    def begin(self) -> Turn:
+        if self.turn is not None:
+            self.turn.abandon()
+        self.turn = Turn()
+        return self.turn
+
+    def abandon(self) -> None:
+        if self.turn is not None:
+            self.turn.abandon()
+
+class SectionStream:
+    # Incrementally extracts one section from streamed completion tokens. Only
+    # the "#"-prefixed tags are matched while streaming, since a bare "Response:"
+    # may just be mentioned in an earlier section; the bare tags are a fallback
+    # once the stream has ended without a "#" tag.
+    def __init__(
+        self,
+        start_tags: list[str],
+    ) -> None:
+        self.start_tags = [tag for tag in start_tags if tag.startswith("#")]
+        self.fallback_tags = [tag for tag in start_tags if not tag.startswith("#")]
+        self.completion = ""
+        self.buffer = ""
+        self.started = False
+        self.emitted = False
+        self.done = False
+
+    def feed(self, token: str) -> list[str]:
+        self.buffer += token
+        if not self.started:
+            self.completion += token
+            start_tag = next((tag for tag in self.start_tags if tag in self.buffer), None)
+            if start_tag is None:
+                return []
+            self.buffer = self.buffer.split(start_tag, 1)[1]
+            self.started = True
+        if not self.emitted:
+            self.buffer = self.buffer.lstrip()
+        if "#" in self.buffer:
+            self.done = True
+            section = self.buffer.split("#")[0].rstrip()
+            return [section] if section else []
+        if self.buffer:
+            self.emitted = True
+            text, self.buffer = self.buffer, ""
+            return [text]
+        return []
+
+    def close(self, title: str) -> list[str]:
+        if self.started:
+            return []
+        start_tag = next((tag for tag in self.fallback_tags if tag in self.completion), None)
+        if start_tag is None:
+            raise ValueError(f"The completion has no {title} section.")
+        section = self.completion.split(start_tag, 1)[1].split("#")[0].strip()
+        return [section] if section else []
 
 class BasePrompter(Model):
     def __init__(
@@ -21,60 +133,161 @@ class BasePrompter(Model):
 
         self.model_class = model_class
         self.model_loaded = False
+        self.turns = TurnFence()
         self.fn = self.prompt
+        self.afn = self.aprompt
     
     def reset(self) -> None:
+        self.turns.abandon()
         self.__instantiate_model()
+        self.messages = []
+
+    def create_session(self) -> "BasePrompter":
+        session = BasePrompter(self.model_class)
+        session.reset()
+        return session
     
     def __instantiate_model(self) -> Model:
-        self.model = self.model_class(context=True)
+        # The conversation is kept in self.messages, so the model itself is shared.
+        self.model = get_shared_model(self.model_class, context=False)
+        self.role_key = "author" if issubclass(self.model_class, PaLM) else "role"
         self.model_loaded = True
         return self.model
     
     def prompt(
         self,
         input: str,
-    ) -> str:
+        stream: bool = False,
+        turn: typing.Optional[Turn] = None,
+    ) -> typing.Union[str, typing.Iterator[str]]:
+        turn = turn or self.turns.begin()
+        if stream:
+            return self.__prompt_stream(input, turn)
+
         completion = "".join(self.model.fn(
             input=input,
             temperature=0.7,
             stop=["\n"],
+            history=self.messages,
+        ))
+        self.__respond(turn, input, completion)
+        return completion
+
+    def __prompt_stream(
+        self,
+        input: str,
+        turn: Turn,
+    ) -> typing.Iterator[str]:
+        completion = ""
+        for token in self.model.fn(
+            input=input,
+            temperature=0.7,
+            stop=["\n"],
+            history=self.messages,
+            stream=True,
+        ):
+            completion += token
+            yield token
+        self.__respond(turn, input, completion)
+
+    async def aprompt(
+        self,
+        input: str,
+        stream: bool = False,
+        turn: typing.Optional[Turn] = None,
+    ) -> typing.Union[str, typing.AsyncIterator[str]]:
+        turn = turn or self.turns.begin()
+        if stream:
+            return self.__aprompt_stream(input, turn)
+
+        completion = "".join(await self.model.acall(
+            input=input,
+            temperature=0.7,
+            stop=["\n"],
+            history=self.messages,
         ))
+        self.__respond(turn, input, completion)
         return completion
 
+    async def __aprompt_stream(
+        self,
+        input: str,
+        turn: Turn,
+    ) -> typing.AsyncIterator[str]:
+        completion = ""
+        async for token in self.model.acall_stream(
+            input=input,
+            temperature=0.7,
+            stop=["\n"],
+            history=self.messages,
+        ):
+            completion += token
+            yield token
+        self.__respond(turn, input, completion)
+
+    def begin_turn(self) -> Turn:
+        # Lets the caller abandon this turn, e.g. when it gives up waiting for it.
+        return self.turns.begin()
+
+    def __respond(
+        self,
+        turn: Turn,
+        input: str,
+        completion: str,
+    ) -> None:
+        turn.commit(lambda: self.messages.extend([
+            {self.role_key: "user", "content": input},
+            {self.role_key: "assistant", "content": completion},
+        ]))
+
 class AugmentedPrompter(Model):
     def __init__(
         self,
         model_class: typing.Type[Model],
+        config: PromptConfig = None,
     ) -> None:
         super().__init__()
 
         self.model_class = model_class
+        self.config = config or PromptConfig()
         self.model_loaded = False
+        self.pending_memorization: typing.Optional[Future] = None
+        self.turns = TurnFence()
         self.fn = self.prompt
+        self.afn = self.aprompt
     
     def reset(self) -> None:
+        self.turns.abandon()
         self.__instantiate_model()
-        self.config = PromptConfig()
+        self.pending_memorization = None
         self.templates = self._load_prompts("conversation/prompts/")
         self.session = {
             "history": [],
             "history_summaries": [],
+            "memorized_index": 0,
             "prefix": None,
             "suffix": None,
         }
-        self.retriever = BiEncoderRetriever()
+        self.retriever = get_retriever(dtype=self.config.retriever_dtype)
+        self.summary_index = SummaryIndex(self.retriever)
+
+    def create_session(self) -> "AugmentedPrompter":
+        session = AugmentedPrompter(self.model_class, self.config)
+        session.reset()
+        return session
     
     def __instantiate_model(self) -> Model:
-        self.model = self.model_class(context=False)
         self.role_key = "role"
 
-        if isinstance(self.model, PaLM):
-            self.model = self.model_class(
+        if issubclass(self.model_class, PaLM):
+            self.model = get_shared_model(
+                self.model_class,
                 model="models/text-bison-001",
                 context=False,
             )
             self.role_key = "author"
+        else:
+            self.model = get_shared_model(self.model_class, context=False)
 
         self.model_loaded = True
         return self.model
@@ -82,47 +295,283 @@ class AugmentedPrompter(Model):
     def prompt(
         self,
         input: str,
-    ) -> str:
+        stream: bool = False,
+        turn: typing.Optional[Turn] = None,
+    ) -> typing.Union[str, typing.Iterator[str]]:
+        turn = turn or self.turns.begin()
+        if stream:
+            return self.__prompt_stream(input, turn)
+
         attempts = 0
-        while attempts < 3:
+        while attempts < 3 and not turn.abandoned:
             try:
-                # Conversation Layer
-                print("\n ** Extractor **")
-                knowledge, query = self.extract(input)
-                print("* Knowledge, Question:", (knowledge, query))
+                if self.config.mode == "fused":
+                    print("\n ** Fused **")
+                    response = self.fuse(input)
+                else:
+                    conclusion, query = self.__converse(input)
 
-                print("\n ** Retriever **")
-                retrieval = self.retrieve(query)
-                print("* Retrieval:", retrieval)
+                    print("\n ** Generator **")
+                    response = self.generate(conclusion, query)
+                print("* Generation:", response)
 
-                print("\n ** Reasoning **")
-                conclusion = self.reasoning(knowledge + retrieval, query)
-                print("* Conclusion:", conclusion)
+                self.__respond(turn, input, response)
 
-                print("\n ** Generator **")
-                response = self.generate(conclusion, query)
+                return response
+            except Exception as e:
+                print(f"Attempt {attempts+1} failed with error: {e}")
+                if attempts < 3:
+                    time.sleep(1)
+                attempts += 1
+        return ERROR_RESPONSE
+
+    def __prompt_stream(
+        self,
+        input: str,
+        turn: Turn,
+    ) -> typing.Iterator[str]:
+        attempts = 0
+        while attempts < 3 and not turn.abandoned:
+            response = ""
+            try:
+                if self.config.mode == "fused":
+                    print("\n ** Fused **")
+                    tokens = self.fuse(input, stream=True)
+                else:
+                    conclusion, query = self.__converse(input)
+
+                    print("\n ** Generator **")
+                    tokens = self.generate(conclusion, query, stream=True)
+
+                for token in tokens:
+                    response += token
+                    yield token
                 print("* Generation:", response)
 
-                extended_history = [
-                    {self.role_key: "user", "content": input},
-                    {self.role_key: "assistant", "content": response},
-                ]
-                self.session["history"].extend(extended_history)
+                self.__respond(turn, input, response)
+                return
+            except Exception as e:
+                print(f"Attempt {attempts+1} failed with error: {e}")
+                if response:
+                    # Part of the response has already been sent.
+                    return
+                if attempts < 3:
+                    time.sleep(1)
+                attempts += 1
+        yield ERROR_RESPONSE
+
+    async def aprompt(
+        self,
+        input: str,
+        stream: bool = False,
+        turn: typing.Optional[Turn] = None,
+    ) -> typing.Union[str, typing.AsyncIterator[str]]:
+        # The stages await the model on the event loop instead of holding a
+        # worker thread for the whole turn.
+        turn = turn or self.turns.begin()
+        if stream:
+            return self.__aprompt_stream(input, turn)
 
-                # Memorization Layer
-                ## TODO: Conversation 결과를 제공한 후 Memorize하여 응답 시간 단축
-                summaries = self.summarize(self.session["history"])
-                print(" ** Summarization **\n", summaries)
+        attempts = 0
+        while attempts < 3 and not turn.abandoned:
+            try:
+                if self.config.mode == "fused":
+                    print("\n ** Fused **")
+                    response = await self.afuse(input)
+                else:
+                    conclusion, query = await self.__aconverse(input)
 
-                self.session["history_summaries"].extend(summaries)
+                    print("\n ** Generator **")
+                    response = await self.agenerate(conclusion, query)
+                print("* Generation:", response)
+
+                await asyncio.to_thread(self.__respond, turn, input, response)
 
                 return response
             except Exception as e:
                 print(f"Attempt {attempts+1} failed with error: {e}")
                 if attempts < 3:
-                    time.sleep(1)
+                    await asyncio.sleep(1)
                 attempts += 1
-        return "Sorry, there was an error processing your request. Please try again, and if the error persists, reset the conversation and start over."
+        return ERROR_RESPONSE
+
+    async def __aprompt_stream(
+        self,
+        input: str,
+        turn: Turn,
+    ) -> typing.AsyncIterator[str]:
+        attempts = 0
+        while attempts < 3 and not turn.abandoned:
+            response = ""
+            try:
+                if self.config.mode == "fused":
+                    print("\n ** Fused **")
+                    tokens = self.afuse(input, stream=True)
+                else:
+                    conclusion, query = await self.__aconverse(input)
+
+                    print("\n ** Generator **")
+                    tokens = self.agenerate(conclusion, query, stream=True)
+
+                async for token in await tokens:
+                    response += token
+                    yield token
+                print("* Generation:", response)
+
+                await asyncio.to_thread(self.__respond, turn, input, response)
+                return
+            except Exception as e:
+                print(f"Attempt {attempts+1} failed with error: {e}")
+                if response:
+                    # Part of the response has already been sent.
+                    return
+                if attempts < 3:
+                    await asyncio.sleep(1)
+                attempts += 1
+        yield ERROR_RESPONSE
+
+    def __converse(
+        self,
+        input: str,
+    ) -> tuple[str, str]:
+        if self.config.speculative_retrieval:
+            return self.__converse_speculatively(input)
+
+        # Conversation Layer
+        print("\n ** Extractor **")
+        knowledge, query = self.extract(input)
+        print("* Knowledge, Question:", (knowledge, query))
+
+        print("\n ** Retriever **")
+        retrieval = self.retrieve(query)
+        print("* Retrieval:", retrieval)
+
+        print("\n ** Reasoning **")
+        conclusion = self.reasoning(knowledge + retrieval, query)
+        print("* Conclusion:", conclusion)
+
+        return conclusion, query
+
+    def __converse_speculatively(
+        self,
+        input: str,
+    ) -> tuple[str, str]:
+        # The history retriever starts from the raw utterance while the extractor
+        # runs. Its answer is only kept when the extracted query is that utterance,
+        # so the retrieval matches the sequential chain.
+        def reconcile_history(extraction: tuple[list[str], str], completion: str) -> str:
+            _, query = extraction
+            if self._normalize_summary(query) != self._normalize_summary(input):
+                print("\n ** Retriever (reconciled) **")
+                return self.retrieve_history(query)
+            return completion
+
+        def reason(extraction: tuple[list[str], str], completion: str, retrieval: list[str]) -> str:
+            knowledge, query = extraction
+            print("* Knowledge, Question:", (knowledge, query))
+
+            retrieval = self._merge_retrieval(completion, retrieval)
+            print("* Retrieval:", retrieval)
+
+            print("\n ** Reasoning **")
+            conclusion = self.reasoning(knowledge + retrieval, query)
+            print("* Conclusion:", conclusion)
+            return conclusion
+
+        graph = StageGraph(_stage_executor)
+        graph.add("extract", lambda: self.extract(input))
+        graph.add("speculative_history", lambda: self.retrieve_history(input))
+        graph.add("history", reconcile_history, ["extract", "speculative_history"])
+        graph.add("summaries", lambda extraction: self.retrieve_summaries(extraction[1]), ["extract"])
+        graph.add("reasoning", reason, ["extract", "history", "summaries"])
+        results = graph.run()
+
+        return results["reasoning"], results["extract"][1]
+
+    async def __aconverse(
+        self,
+        input: str,
+    ) -> tuple[str, str]:
+        if self.config.speculative_retrieval:
+            return await self.__aconverse_speculatively(input)
+
+        # Conversation Layer
+        print("\n ** Extractor **")
+        knowledge, query = await self.aextract(input)
+        print("* Knowledge, Question:", (knowledge, query))
+
+        print("\n ** Retriever **")
+        completion, retrieval = await asyncio.gather(
+            self.aretrieve_history(query),
+            self.aretrieve_summaries(query),
+        )
+        retrieval = self._merge_retrieval(completion, retrieval)
+        print("* Retrieval:", retrieval)
+
+        print("\n ** Reasoning **")
+        conclusion = await self.areasoning(knowledge + retrieval, query)
+        print("* Conclusion:", conclusion)
+
+        return conclusion, query
+
+    async def __aconverse_speculatively(
+        self,
+        input: str,
+    ) -> tuple[str, str]:
+        # Same stages as __converse_speculatively, as tasks on the event loop.
+        extraction = asyncio.ensure_future(self.aextract(input))
+        speculative_history = asyncio.ensure_future(self.aretrieve_history(input))
+
+        async def history() -> str:
+            _, query = await extraction
+            if self._normalize_summary(query) != self._normalize_summary(input):
+                print("\n ** Retriever (reconciled) **")
+                speculative_history.cancel()
+                return await self.aretrieve_history(query)
+            return await speculative_history
+
+        async def summaries() -> list[str]:
+            _, query = await extraction
+            return await self.aretrieve_summaries(query)
+
+        try:
+            completion, retrieval = await asyncio.gather(history(), summaries())
+        finally:
+            for task in (extraction, speculative_history):
+                task.cancel()
+
+        knowledge, query = extraction.result()
+        print("* Knowledge, Question:", (knowledge, query))
+
+        retrieval = self._merge_retrieval(completion, retrieval)
+        print("* Retrieval:", retrieval)
+
+        print("\n ** Reasoning **")
+        conclusion = await self.areasoning(knowledge + retrieval, query)
+        print("* Conclusion:", conclusion)
+
+        return conclusion, query
+
+    def begin_turn(self) -> Turn:
+        # Lets the caller abandon this turn, e.g. when it gives up waiting for it.
+        return self.turns.begin()
+
+    def __respond(
+        self,
+        turn: Turn,
+        input: str,
+        response: str,
+    ) -> None:
+        extended_history = [
+            {self.role_key: "user", "content": input},
+            {self.role_key: "assistant", "content": response},
+        ]
+
+        # Only the history append is fenced; memorization may call the model and
+        # must not hold the turn lock that abandon() waits on.
+        if turn.commit(lambda: self.session["history"].extend(extended_history)):
+            # Memorization Layer
+            self.memorize()
 
     def clarify(
         self,
@@ -159,11 +608,37 @@ class AugmentedPrompter(Model):
         query = self._parse_completion(completion, "Query")[0]
     
         return knowledge, query
+
+    async def aextract(
+        self,
+        input: str,
+    ) -> tuple[list[str], str]:
+        prompt = self.templates["extractor"].format(
+            input=input,
+        )
+        completion = "".join(await self.model.acall(
+            input=prompt,
+            temperature=0,
+        ))
+        print("* Completion:", completion)
+
+        knowledge = self._parse_completion(completion, "Knowledge")
+        query = self._parse_completion(completion, "Query")[0]
+
+        return knowledge, query
     
     def retrieve(
         self,
         query: str,
     ) -> list[str]:
+        completion = self.retrieve_history(query)
+        retrieval = self.retrieve_summaries(query)
+        return self._merge_retrieval(completion, retrieval)
+
+    def retrieve_history(
+        self,
+        query: str,
+    ) -> str:
         prompt = self.templates["retriever"].format(
             question=query,
         )
@@ -175,23 +650,67 @@ class AugmentedPrompter(Model):
         ))
         print("* History:", self.session["history"])
         print("* Completion:", completion)
+        return completion
 
-        hsitory_content = [f"{x[self.role_key]}: {x['content']}" for x in self.session["history"]]
+    async def aretrieve_history(
+        self,
+        query: str,
+    ) -> str:
+        prompt = self.templates["retriever"].format(
+            question=query,
+        )
+        print("* Prompt:", prompt)
+        completion = "".join(await self.model.acall(
+            input=prompt,
+            temperature=0,
+            history=self.session["history"],
+        ))
+        print("* History:", self.session["history"])
+        print("* Completion:", completion)
+        return completion
+
+    def retrieve_summaries(
+        self,
+        query: str,
+    ) -> list[str]:
+        # The summaries of the previous turn may still be in progress.
+        self.wait_memorization()
 
         if len(self.session["history_summaries"]) == 0:
-            if "i can't answer" in completion.strip().lower() or "i cannot answer" in completion.strip().lower():
-                return hsitory_content
-            return [completion]
+            return []
 
-        retrieval = self.retriever.retrieve_top_summaries(
+        return self.summary_index.retrieve_top_summaries(
             query, self.session["history_summaries"],
         )
 
-        if "i can't answer" in completion.strip().lower() or "i cannot answer" in completion.strip().lower():
-            if retrieval:
-                return retrieval
-            return self.session["history_summaries"]
+    async def aretrieve_summaries(
+        self,
+        query: str,
+    ) -> list[str]:
+        # Waiting for memorization and encoding the query block, so they run off the loop.
+        return await asyncio.to_thread(self.retrieve_summaries, query)
+
+    def _merge_retrieval(
+        self,
+        completion: str,
+        retrieval: list[str],
+    ) -> list[str]:
+        hsitory_content = [f"{x[self.role_key]}: {x['content']}" for x in self.session["history"]]
+
+        if not retrieval:
+            if self._cannot_answer(completion):
+                return hsitory_content
+            return [completion]
+
+        if self._cannot_answer(completion):
+            return retrieval
         return [completion] + retrieval
+
+    def _cannot_answer(
+        self,
+        completion: str,
+    ) -> bool:
+        return "i can't answer" in completion.strip().lower() or "i cannot answer" in completion.strip().lower()
     
     def reasoning(
         self,
@@ -220,16 +739,44 @@ class AugmentedPrompter(Model):
         
         return conclusion
 
+    async def areasoning(
+        self,
+        knowledge: list[str],
+        query: str,
+    ) -> str:
+        prompt = self.templates["reasoner"].format(
+            knowledge="\n".join(f"({i+1}) {item}" for i, item in enumerate(knowledge)),
+            query=query,
+        )
+        print("* Prompt:", prompt)
+        completion = "".join(await self.model.acall(
+            input=prompt,
+            temperature=0,
+        ))
+        print("* Completion:", completion)
+
+        if len(completion) == 0:
+            print("** No conclusions were reached. **")
+        return completion
+
     def generate(
         self,
         information: str,
         query: str,
-    ) -> str:
+        stream: bool = False,
+    ) -> typing.Union[str, typing.Iterator[str]]:
         prompt = self.templates["generator"].format(
             query=query,
             information=information,
         )
         print("* Prompt:", prompt)
+        if stream:
+            return self.model.fn(
+                input=prompt,
+                temperature=0.7,
+                stream=True,
+            )
+
         completion = "".join(self.model.fn(
             input=prompt,
             temperature=0.7,
@@ -237,14 +784,156 @@ class AugmentedPrompter(Model):
         print("* Completion:", completion)
         
         return completion
+
+    async def agenerate(
+        self,
+        information: str,
+        query: str,
+        stream: bool = False,
+    ) -> typing.Union[str, typing.AsyncIterator[str]]:
+        prompt = self.templates["generator"].format(
+            query=query,
+            information=information,
+        )
+        print("* Prompt:", prompt)
+        if stream:
+            return self.model.acall_stream(
+                input=prompt,
+                temperature=0.7,
+            )
+
+        completion = "".join(await self.model.acall(
+            input=prompt,
+            temperature=0.7,
+        ))
+        print("* Completion:", completion)
+
+        return completion
     
+    def memorize(self) -> None:
+        self.wait_memorization()
+
+        if self.config.background_memorization:
+            self.pending_memorization = _memorization_executor.submit(
+                self._memorize, self.session,
+            )
+        else:
+            self._memorize(self.session)
+
+    def wait_memorization(self) -> None:
+        pending = self.pending_memorization
+        if pending is None:
+            return
+        try:
+            pending.result()
+        except Exception as e:
+            print(f"Memorization failed with error: {e}")
+        finally:
+            if self.pending_memorization is pending:
+                self.pending_memorization = None
+
+    def _memorize(
+        self,
+        session: dict,
+    ) -> None:
+        # The session is bound at submission, so a reset() in between
+        # discards the result together with the old session.
+        history = session["history"]
+        end = len(history)
+        start = session["memorized_index"]
+        if start >= end:
+            return
+
+        if self.config.incremental_memorization:
+            # The window is context for the new turns and is not summarized again.
+            window_start = max(0, start - self.config.memorization_window)
+            summaries = self.summarize(history[start:end], memorized=history[window_start:start])
+        else:
+            summaries = self.summarize(history[:end])
+        print(" ** Summarization **\n", summaries)
+
+        memorized = {self._normalize_summary(x) for x in session["history_summaries"]}
+        for summary in summaries:
+            key = self._normalize_summary(summary)
+            if key and key not in memorized:
+                memorized.add(key)
+                session["history_summaries"].append(summary)
+        session["memorized_index"] = end
+
+    def fuse(
+        self,
+        input: str,
+        stream: bool = False,
+    ) -> typing.Union[str, typing.Iterator[str]]:
+        # Extraction, reasoning and generation in a single completion.
+        prompt = self.__fused_prompt(input)
+        print("* Prompt:", prompt)
+        if stream:
+            return self._stream_section(self.model.fn(
+                input=prompt,
+                temperature=0.7,
+                stream=True,
+            ), "Response")
+
+        completion = "".join(self.model.fn(
+            input=prompt,
+            temperature=0.7,
+        ))
+        print("* Completion:", completion)
+
+        response = self._parse_completion(completion, "Response")
+        if not response:
+            raise ValueError("The completion has no #Response section.")
+        return " ".join(response)
+
+    async def afuse(
+        self,
+        input: str,
+        stream: bool = False,
+    ) -> typing.Union[str, typing.AsyncIterator[str]]:
+        prompt = await asyncio.to_thread(self.__fused_prompt, input)
+        print("* Prompt:", prompt)
+        if stream:
+            return self._astream_section(self.model.acall_stream(
+                input=prompt,
+                temperature=0.7,
+            ), "Response")
+
+        completion = "".join(await self.model.acall(
+            input=prompt,
+            temperature=0.7,
+        ))
+        print("* Completion:", completion)
+
+        response = self._parse_completion(completion, "Response")
+        if not response:
+            raise ValueError("The completion has no #Response section.")
+        return " ".join(response)
+
+    def __fused_prompt(
+        self,
+        input: str,
+    ) -> str:
+        memory = self.retrieve_summaries(input)
+        history = self.session["history"][-self.config.fused_history_window:] if self.config.fused_history_window > 0 else []
+        dialogue = "\n".join(f"{item[self.role_key]}: {item['content']}" for item in history)
+
+        return self.templates["fused"].format(
+            dialogue=dialogue or "(none)",
+            memory="\n".join(f"({i+1}) {item}" for i, item in enumerate(memory)) or "(none)",
+            input=input,
+        )
+
     def summarize(
         self,
         history: list[dict[str, str]],
+        memorized: typing.Optional[list[dict[str, str]]] = None,
     ) -> list[str]:
         dialogue = "\n".join(f"{item[self.role_key]}: {item['content']}" for item in history)
+        context = "\n".join(f"{item[self.role_key]}: {item['content']}" for item in memorized or [])
 
         prompt = self.templates["summarizer"].format(
+            memorized=context or "(none)",
             dialogue=dialogue,
         )
         print("* Prompt:", prompt)
@@ -274,6 +963,9 @@ class AugmentedPrompter(Model):
         self,
         directory: str,
     ) -> dict[str, str]:
+        if directory in _prompt_templates:
+            return _prompt_templates[directory]
+
         prompts = {}
         for filename in os.listdir(directory):
             if filename.endswith(".txt"):
@@ -284,6 +976,8 @@ class AugmentedPrompter(Model):
                     
                 name_without_extension = os.path.splitext(filename)[0]
                 prompts[name_without_extension] = content    
+
+        _prompt_templates[directory] = prompts
         return prompts
     
     def _parse_completion(
@@ -291,7 +985,7 @@ class AugmentedPrompter(Model):
         completion: str,
         title: str
     ) -> typing.Union[list[str], str]:
-        start_tags = [f"#{title}\n", f"#{title}:", f"{title}:", f"{title}\n"]
+        start_tags = self._section_start_tags(title)
         end_tag = "#"
         
         start_tag = next((tag for tag in start_tags if tag in completion), None)
@@ -307,6 +1001,46 @@ class AugmentedPrompter(Model):
         else:
             return []
 
+    def _section_start_tags(
+        self,
+        title: str,
+    ) -> list[str]:
+        return [f"#{title}\n", f"#{title}:", f"{title}:", f"{title}\n"]
+
+    def _stream_section(
+        self,
+        tokens: typing.Iterator[str],
+        title: str,
+    ) -> typing.Iterator[str]:
+        # Streams only the content of the {title} section of a completion,
+        # recognized by the same start tags as _parse_completion.
+        section = SectionStream(self._section_start_tags(title))
+        for token in tokens:
+            yield from section.feed(token)
+            if section.done:
+                return
+        yield from section.close(title)
+
+    async def _astream_section(
+        self,
+        tokens: typing.AsyncIterator[str],
+        title: str,
+    ) -> typing.AsyncIterator[str]:
+        section = SectionStream(self._section_start_tags(title))
+        async for token in tokens:
+            for text in section.feed(token):
+                yield text
+            if section.done:
+                return
+        for text in section.close(title):
+            yield text
+
+    def _normalize_summary(
+        self,
+        summary: str,
+    ) -> str:
+        return " ".join(summary.lower().split()).rstrip(".")
+
     def _combine_knowledge(
         self, 
         *args,
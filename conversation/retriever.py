@@ -1,27 +1,102 @@
+import threading
 import torch
 import numpy as np
 
 from transformers import AutoTokenizer, DPRQuestionEncoder, DPRContextEncoder
-from typing import List
+from typing import Dict, List, Tuple
+
+QUESTION_ENCODER = "sivasankalpp/dpr-multidoc2dial-structure-question-encoder"
+CONTEXT_ENCODER = "sivasankalpp/dpr-multidoc2dial-structure-ctx-encoder"
+
+_retrievers: Dict[Tuple[str, str, str], "BiEncoderRetriever"] = {}
+_retrievers_lock = threading.Lock()
+
+def get_retriever(
+    question_encoder: str = QUESTION_ENCODER,
+    ctxt_encoder: str = CONTEXT_ENCODER,
+    dtype: str = "float32",
+) -> "BiEncoderRetriever":
+    # Encoder weights are loaded once per process and shared read-only by all sessions.
+    key = (question_encoder, ctxt_encoder, dtype)
+    retriever = _retrievers.get(key)
+    if retriever is None:
+        with _retrievers_lock:
+            retriever = _retrievers.get(key)
+            if retriever is None:
+                retriever = BiEncoderRetriever(question_encoder, ctxt_encoder, dtype=dtype)
+                _retrievers[key] = retriever
+    return retriever
 
 class BiEncoderRetriever:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        question_encoder: str = QUESTION_ENCODER,
+        ctxt_encoder: str = CONTEXT_ENCODER,
+        dtype: str = "float32",  # float32, bfloat16, float16 (CUDA only) or int8 (CPU only)
+        batch_size: int = 32,
+    ) -> None:
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        self.tokenizer = AutoTokenizer.from_pretrained("sivasankalpp/dpr-multidoc2dial-structure-question-encoder")
-        self.question_encoder = DPRQuestionEncoder.from_pretrained("sivasankalpp/dpr-multidoc2dial-structure-question-encoder").to(self.device)
-        self.ctxt_encoder = DPRContextEncoder.from_pretrained("sivasankalpp/dpr-multidoc2dial-structure-ctx-encoder").to(self.device)
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(question_encoder)
+        # The fast tokenizer keeps its truncation settings in mutable state, so
+        # concurrent calls with different settings fail with "Already borrowed".
+        self.tokenizer_lock = threading.Lock()
+        self.question_encoder = self.__load_encoder(DPRQuestionEncoder, question_encoder, dtype)
+        self.ctxt_encoder = self.__load_encoder(DPRContextEncoder, ctxt_encoder, dtype)
+
+    def __load_encoder(self, encoder_class, name: str, dtype: str):
+        if dtype == "int8":
+            assert self.device == "cpu", "int8 quantization is only supported on CPU"
+            encoder = encoder_class.from_pretrained(name)
+            encoder = torch.ao.quantization.quantize_dynamic(
+                encoder, {torch.nn.Linear}, dtype=torch.qint8,
+            )
+        else:
+            # CPU builds of torch 2.0 have no Half kernels for addmm and LayerNorm.
+            assert dtype != "float16" or self.device != "cpu", "float16 is only supported on CUDA"
+            encoder = encoder_class.from_pretrained(name, torch_dtype=getattr(torch, dtype))
+        encoder.to(self.device)
+        encoder.eval()
+        return encoder
+
+    def __tokenize(self, texts: List[str], max_length: int):
+        with self.tokenizer_lock:
+            return self.tokenizer(texts, max_length=max_length, truncation=True, return_token_type_ids=False)
+
+    def __encode(self, encoder, features: dict) -> torch.Tensor:
+        # Pads only to the longest input of the batch.
+        with self.tokenizer_lock:
+            input_dict = self.tokenizer.pad(features, padding="longest", return_tensors="pt")
+        input_dict = input_dict.to(self.device)
+        with torch.inference_mode():
+            return encoder(**input_dict)["pooler_output"].float()
 
     def encode_summaries(self, summaries: List[str]):
-        input_dict = self.tokenizer(summaries, padding='max_length', max_length=128, truncation=True, return_tensors="pt").to(self.device)
-        del input_dict["token_type_ids"]
-        return self.ctxt_encoder(**input_dict)['pooler_output']
+        tokenized = self.__tokenize(summaries, max_length=128)
+        input_ids = tokenized["input_ids"]
+        attention_mask = tokenized["attention_mask"]
+
+        # Batches inputs of similar length together to minimize padding.
+        order = sorted(range(len(summaries)), key=lambda i: len(input_ids[i]))
+        encoded = [None] * len(summaries)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            embeddings = self.__encode(self.ctxt_encoder, {
+                "input_ids": [input_ids[i] for i in batch],
+                "attention_mask": [attention_mask[i] for i in batch],
+            })
+            for i, embedding in zip(batch, embeddings):
+                encoded[i] = embedding
+        return torch.stack(encoded)
 
     def encode_question(self, question: str):
-        input_dict = self.tokenizer(question, padding='max_length', max_length=32, truncation=True, return_tensors="pt").to(self.device)
-        del input_dict["token_type_ids"]
-        return self.question_encoder(**input_dict)['pooler_output']
+        tokenized = self.__tokenize([question], max_length=32)
+        return self.__encode(self.question_encoder, dict(tokenized))
 
     def retrieve_top_summaries(self, question: str, summaries: List[str], encoded_summaries: np.ndarray = None, topk: int = 5):
+        if topk >= len(summaries):
+            return summaries
+
         encoded_question = self.encode_question(question)
         if encoded_summaries is None:
             encoded_summaries = self.encode_summaries(summaries)
@@ -29,7 +104,38 @@ class BiEncoderRetriever:
             encoded_summaries = torch.from_numpy(encoded_summaries).to(self.device)
 
         scores = torch.mm(encoded_question, encoded_summaries.T)
-        if topk >= len(summaries):
-            return summaries
         top_k = torch.topk(scores, topk).indices.squeeze()
         return [summaries[i] for i in top_k]
+
+class SummaryIndex:
+    # Append-only cache of a session's summary embeddings.
+    def __init__(self, retriever: BiEncoderRetriever) -> None:
+        self.retriever = retriever
+        self.reset()
+
+    def reset(self) -> None:
+        self.summaries: List[str] = []
+        self.encoded_summaries: np.ndarray = None
+
+    def update(self, summaries: List[str]) -> None:
+        num_encoded = len(self.summaries)
+        if len(summaries) < num_encoded or summaries[:num_encoded] != self.summaries:
+            self.reset()
+            num_encoded = 0
+
+        new_summaries = summaries[num_encoded:]
+        if not new_summaries:
+            return
+
+        encoded = self.retriever.encode_summaries(new_summaries).cpu().numpy()
+        if self.encoded_summaries is None:
+            self.encoded_summaries = encoded
+        else:
+            self.encoded_summaries = np.concatenate([self.encoded_summaries, encoded])
+        self.summaries.extend(new_summaries)
+
+    def retrieve_top_summaries(self, question: str, summaries: List[str], topk: int = 5):
+        self.update(summaries)
+        return self.retriever.retrieve_top_summaries(
+            question, list(self.summaries), encoded_summaries=self.encoded_summaries, topk=topk,
+        )
@@ -0,0 +1,131 @@
+import json
+import os
+import os.path as osp
+import threading
+import time
+import typing
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+@dataclass
+class Session:
+    temp: dict
+    data: dict
+    model: typing.Any
+    last_access: float = field(default_factory=time.monotonic)
+
+class SessionStore:
+    def __init__(
+        self,
+        create_model: typing.Callable[[], typing.Any],
+        max_sessions: int = 256,
+        ttl: float = 12 * 60 * 60,  # seconds since last access
+        spill_path: str = "results/sessions",
+    ) -> None:
+        self.create_model = create_model
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.spill_path = spill_path
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        self.lock = threading.RLock()
+
+    def create(
+        self,
+        session_id: str,
+        temp: dict,
+        data: dict,
+    ) -> Session:
+        session = Session(temp=temp, data=data, model=self.create_model())
+        with self.lock:
+            self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            self.__remove_spill(session_id)
+            self.__evict()
+        return session
+
+    def get(
+        self,
+        session_id: str,
+    ) -> Session:
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.__rehydrate(session_id)
+            session.last_access = time.monotonic()
+            self.sessions.move_to_end(session_id)
+            self.__evict()
+            return session
+
+    def view(
+        self,
+        name: str,
+    ) -> "SessionView":
+        return SessionView(self, name)
+
+    def __contains__(self, session_id: str) -> bool:
+        with self.lock:
+            return session_id in self.sessions or osp.exists(self.__spill_file(session_id))
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __evict(self) -> None:
+        # Sessions are ordered by last access, so expired ones are at the front.
+        now = time.monotonic()
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and now - session.last_access < self.ttl:
+                break
+            del self.sessions[session_id]
+            self.__spill(session_id, session)
+
+    def __spill(
+        self,
+        session_id: str,
+        session: Session,
+    ) -> None:
+        os.makedirs(self.spill_path, exist_ok=True)
+        with open(self.__spill_file(session_id), "w", encoding="utf-8") as file:
+            json.dump({"temp": session.temp, "data": session.data}, file)
+
+    def __rehydrate(
+        self,
+        session_id: str,
+    ) -> Session:
+        filepath = self.__spill_file(session_id)
+        if not osp.exists(filepath):
+            raise KeyError(session_id)
+
+        with open(filepath, "r", encoding="utf-8") as file:
+            spilled = json.load(file)
+        os.remove(filepath)
+
+        # The conversation state of the model is not kept, only the collected data.
+        session = Session(temp=spilled["temp"], data=spilled["data"], model=self.create_model())
+        self.sessions[session_id] = session
+        return session
+
+    def __remove_spill(self, session_id: str) -> None:
+        filepath = self.__spill_file(session_id)
+        if osp.exists(filepath):
+            os.remove(filepath)
+
+    def __spill_file(self, session_id: str) -> str:
+        userid = session_id.replace("/", "-")
+        return osp.join(self.spill_path, f"user_{userid}_session.json")
+
+class SessionView:
+    # Dict-like access to one field of every session, keyed by session id.
+    def __init__(
+        self,
+        store: SessionStore,
+        name: str,
+    ) -> None:
+        self.store = store
+        self.name = name
+
+    def __getitem__(self, session_id: str):
+        return getattr(self.store.get(session_id), self.name)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.store
@@ -0,0 +1,49 @@
+import typing
+from concurrent.futures import Executor, Future, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+
+@dataclass
+class Stage:
+    name: str
+    fn: typing.Callable
+    deps: tuple[str, ...] = ()
+
+class StageGraph:
+    # Runs each stage as soon as the stages it depends on have finished.
+    # A stage receives the results of its dependencies as positional arguments.
+    def __init__(
+        self,
+        executor: Executor,
+    ) -> None:
+        self.executor = executor
+        self.stages: dict[str, Stage] = {}
+
+    def add(
+        self,
+        name: str,
+        fn: typing.Callable,
+        deps: typing.Sequence[str] = (),
+    ) -> None:
+        self.stages[name] = Stage(name, fn, tuple(deps))
+
+    def run(self) -> dict[str, typing.Any]:
+        results = {}
+        pending = dict(self.stages)
+        running: dict[Future, str] = {}
+
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.deps):
+                    args = [results[dep] for dep in stage.deps]
+                    running[self.executor.submit(stage.fn, *args)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Unresolvable stage dependencies: {list(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+
+        return results
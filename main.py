@@ -1,7 +1,9 @@
+import typing
 import fire
 from dotenv import load_dotenv
 from utils.launch import Launcher, LaunchConfig
 from utils.pipeline import Pipeline, PairwisePipeline
+from utils.clients import configure_clients
 
 load_dotenv()
 launcher = Launcher()
@@ -27,15 +29,19 @@ def run_whisperx(**kwargs):
     config = LaunchConfig(**kwargs, title="MAIA (WhisperX Only)")
     launcher.launch_gradio(whisper, config)
 
-def run_alpaca(**kwargs):
+def run_alpaca(max_batch_size: int = 1, **kwargs):
     from models.alpaca.core import Alpaca
     
+    # Each user keeps their own conversation. With max_batch_size > 1 their prompts
+    # are batched through a generation server instead of reusing the prefix cache.
     alpaca = Alpaca(
         device=launcher.get_device(),
         load_8bit=True,
         base_model="decapoda-research/llama-7b-hf",
         lora_weights="tloen/alpaca-lora-7b",
+        max_batch_size=max_batch_size,
     )
+    alpaca.serve_sessions()
 
     config = LaunchConfig(**kwargs, title="MAIA (Alpaca Only)")
     launcher.launch_gradio(alpaca, config)
@@ -58,38 +64,61 @@ def run_palm(google_api_key: str = "", **kwargs):
     
 def run_googletts(google_tts_api_key: str = "", **kwargs):
     from models.googletts.core import GoogleTTS
+    from conversation.prompter import ERROR_RESPONSE
     
     papago = GoogleTTS(api_key=google_tts_api_key)
+    papago.prewarm([ERROR_RESPONSE])
     
     config = LaunchConfig(**kwargs, title="MAIA (GoogleTTS Only)")
     launcher.launch_gradio(papago, config)
 
-def main(**kwargs):
+def main(
+    stream: bool = True,
+    prompt_mode: str = "chain",
+    request_timeout: float = 60.0,
+    http_pool_size: int = 32,
+    max_sessions: int = 256,
+    session_ttl: float = 12 * 60 * 60,
+    memorization_workers: typing.Optional[int] = None,
+    **kwargs,
+):
     from models.whisperx.core import WhisperX
     from models.chatgpt.core import ChatGPT
     from models.palm.core import PaLM
-    from conversation.prompter import BasePrompter, AugmentedPrompter
+    from conversation.prompter import BasePrompter, AugmentedPrompter, PromptConfig, configure_memorization
     from conversation.form import ConversationForm
+
+    configure_clients(timeout=request_timeout, pool_maxsize=http_pool_size)
+    # Memorization issues LLM calls of its own, so it scales with the LLM limit by default.
+    configure_memorization(memorization_workers or kwargs.get("llm_concurrency") or 4)
     
     whisper = WhisperX(
         device=launcher.get_device(),
         device_index=0,
         compute_type="float32",
         batch_size=16,
+        align=False,
+        batch_window=0.05,
     )
 
     model_class = ChatGPT
     base_model = BasePrompter(model_class)
-    augmented_model = AugmentedPrompter(model_class)
+    augmented_model = AugmentedPrompter(model_class, PromptConfig(mode=prompt_mode))
 
     pipeline = PairwisePipeline(
         transcribe_model=whisper,
         generate_model_1=base_model,
         generate_model_2=augmented_model,
+        stream=stream,
     )
 
     config = LaunchConfig(**kwargs)
-    launcher.launch_gradio(pipeline, config, ConversationForm)
+    launcher.launch_gradio(
+        pipeline,
+        config,
+        ConversationForm,
+        form_kwargs={"max_sessions": max_sessions, "session_ttl": session_ttl},
+    )
 
 if __name__ == "__main__":
     fire.Fire(main)
@@ -1,5 +1,8 @@
+import copy
 import os
 import sys
+import threading
+from collections import OrderedDict
 
 import gradio as gr
 import torch
@@ -7,8 +10,10 @@ import transformers
 from peft import PeftModel
 from transformers import GenerationConfig, LlamaForCausalLM, LlamaTokenizer
 
-from .utils.callbacks import Iteratorize, Stream
+from .utils.callbacks import IncrementalDecoder, Iteratorize, Stream
+from .utils.kv_cache import PrefixCache
 from .utils.prompter import Prompter
+from .utils.server import GenerationServer
 
 from utils.model import Model
 
@@ -21,6 +26,9 @@ class Alpaca(Model):
         lora_weights: str = "tloen/alpaca-lora-7b",
         prompt_template: str = "",
         context: bool = True,
+        prefix_cache: bool = True,
+        max_batch_size: int = 1,  # > 1 batches concurrent sessions through a GenerationServer
+        batch_window: float = 0.05,
     ):
         self.base_model = base_model or os.environ.get("BASE_MODEL", "")
         assert (
@@ -82,8 +90,65 @@ class Alpaca(Model):
         self.role = "assistant"
         self.messages = []
         self.context = context
+        # Each turn extends the previous prompt, so its prefill can be reused. Batched
+        # rows are prefilled together by the server, so the cache and the server are
+        # mutually exclusive: the cache is only used when max_batch_size is 1.
+        self.prefix_cache = PrefixCache() if prefix_cache and context and max_batch_size <= 1 else None
+        self.server = None
+        if max_batch_size > 1:
+            self.server = GenerationServer(
+                self.model,
+                device=self.device,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                window=batch_window,
+                max_batch_size=max_batch_size,
+            )
 
         self.setup_interface(self.evaluate, self.get_inputs(), self.get_outputs())
+
+    def create_session(self) -> "Alpaca":
+        # Shares the weights and the generation server; only the conversation is per session.
+        session = copy.copy(self)
+        session.messages = []
+        session.prefix_cache = PrefixCache() if self.prefix_cache is not None else None
+        session.setup_interface(session.evaluate, self.inputs, self.outputs)
+        return session
+
+    def serve_sessions(self, max_sessions: int = 8) -> None:
+        # Routes each browser session to its own create_session() instance, so the
+        # conversation (and its prefix cache) is not shared between users. The
+        # least recently used sessions are dropped; each holds a KV cache.
+        self.max_sessions = max_sessions
+        self.sessions: OrderedDict[str, Alpaca] = OrderedDict()
+        self.sessions_lock = threading.Lock()
+        self.setup_interface(self.evaluate_session, self.inputs, self.outputs)
+
+    def evaluate_session(
+        self,
+        instruction,
+        input,
+        temperature,
+        top_p,
+        top_k,
+        num_beams,
+        max_new_tokens,
+        stream_output,
+        mode,
+        request: gr.Request,
+    ):
+        with self.sessions_lock:
+            session = self.sessions.get(request.session_hash)
+            if session is None:
+                session = self.sessions[request.session_hash] = self.create_session()
+            self.sessions.move_to_end(request.session_hash)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+        yield from session.evaluate(
+            instruction, input, temperature, top_p, top_k,
+            num_beams, max_new_tokens, stream_output, mode,
+        )
         
     def evaluate(
         self,
@@ -92,9 +157,11 @@ class Alpaca(Model):
         temperature=0.1,
         top_p=0.75,
         top_k=40,
-        num_beams=4,
+        num_beams=1,
         max_new_tokens=128,
         stream_output=False,
+        mode="greedy",  # "greedy" or "sample" for low latency, "beam" for quality
+        output_scores=False,
         **kwargs,
     ):
         if self.context:
@@ -106,22 +173,40 @@ class Alpaca(Model):
         
         inputs = self.tokenizer(prompt, return_tensors="pt")
         input_ids = inputs["input_ids"].to(self.device)
+        if mode not in ("greedy", "sample", "beam"):
+            raise ValueError(f"Unknown generation mode: {mode}")
+        # An explicit num_beams > 1 selects beam search in any mode (sampled within beams for "sample").
+        if mode == "beam" and num_beams <= 1:
+            num_beams = 4
+
         generation_config = GenerationConfig(
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
             num_beams=num_beams,
+            do_sample=mode == "sample",
             **kwargs,
         )
 
+        # Per-step scores are only kept when the caller asks for them.
         generate_params = {
             "input_ids": input_ids,
             "generation_config": generation_config,
-            "return_dict_in_generate": True,
-            "output_scores": True,
+            "return_dict_in_generate": output_scores,
+            "output_scores": output_scores,
             "max_new_tokens": max_new_tokens,
         }
 
+        if self.server is not None and num_beams == 1:
+            yield from self.__evaluate_batched(input_ids, generation_config, max_new_tokens, stream_output)
+            return
+
+        # Beam search expands the cache per beam, so only single-sequence decoding reuses it.
+        if self.prefix_cache is not None and num_beams == 1:
+            past_key_values = self.prefix_cache.prefill(self.model, input_ids)
+            if past_key_values is not None:
+                generate_params["past_key_values"] = past_key_values
+
         if stream_output:
             # Stream the reply 1 token at a time.
             # This is based on the trick of using 'stopping_criteria' to create an iterator,
@@ -142,27 +227,29 @@ class Alpaca(Model):
                     generate_with_callback, kwargs, callback=None
                 )
 
+            # Only the newly generated tokens are decoded at each step.
+            decoder = IncrementalDecoder(self.tokenizer)
+            prompt_length = input_ids.shape[1]
             with generate_with_streaming(**generate_params) as generator:
                 for output in generator:
-                    # new_tokens = len(output) - len(input_ids[0])
-                    decoded_output = self.tokenizer.decode(output)
-
                     if output[-1] in [self.tokenizer.eos_token_id]:
                         break
 
-                    yield self.prompter.get_response(decoded_output)
+                    if num_beams > 1:
+                        # The best beam can change earlier tokens, so decode it from scratch.
+                        decoder.reset()
+                    if decoder.decode(output[prompt_length:]):
+                        yield decoder.text.strip()
+
+            if self.context:
+                self.messages.append((self.role, decoder.text.strip()))
             return  # early return for stream_output
 
         # Without streaming
         with torch.no_grad():
-            generation_output = self.model.generate(
-                input_ids=input_ids,
-                generation_config=generation_config,
-                return_dict_in_generate=True,
-                output_scores=True,
-                max_new_tokens=max_new_tokens,
-            )
-        s = generation_output.sequences[0]
+            generation_output = self.model.generate(**generate_params)
+        sequences = generation_output.sequences if output_scores else generation_output
+        s = sequences[0]
         output = self.tokenizer.decode(s)
         response = self.prompter.get_response(output)
 
@@ -170,6 +257,20 @@ class Alpaca(Model):
             self.messages.append((self.role, "".join(response)))
 
         yield response
+
+    def __evaluate_batched(self, input_ids, generation_config, max_new_tokens, stream_output):
+        decoder = IncrementalDecoder(self.tokenizer)
+        token_ids = []
+        for token_ids in self.server.generate(input_ids[0].tolist(), generation_config, max_new_tokens):
+            if stream_output and decoder.decode(token_ids):
+                yield decoder.text.strip()
+
+        if not stream_output:
+            decoder.decode(token_ids)
+            yield decoder.text.strip()
+
+        if self.context:
+            self.messages.append((self.role, decoder.text.strip()))
         
     def get_inputs(self):
         return [
@@ -189,12 +290,15 @@ class Alpaca(Model):
                 minimum=0, maximum=100, step=1, value=40, label="Top k"
             ),
             gr.components.Slider(
-                minimum=1, maximum=4, step=1, value=4, label="Beams"
+                minimum=1, maximum=4, step=1, value=1, label="Beams"
             ),
             gr.components.Slider(
                 minimum=1, maximum=2000, step=1, value=128, label="Max tokens"
             ),
             gr.components.Checkbox(label="Stream output"),
+            gr.components.Radio(
+                choices=["greedy", "sample", "beam"], value="greedy", label="Mode"
+            ),
         ]
     
     def get_outputs(self):
@@ -8,7 +8,7 @@ import transformers
 from peft import PeftModel
 from transformers import GenerationConfig, LlamaForCausalLM, LlamaTokenizer
 
-from utils.callbacks import Iteratorize, Stream
+from utils.callbacks import IncrementalDecoder, Iteratorize, Stream
 from utils.prompter import Prompter
 
 if torch.cuda.is_available():
@@ -90,27 +90,37 @@ def main(
         temperature=0.1,
         top_p=0.75,
         top_k=40,
-        num_beams=4,
+        num_beams=1,
         max_new_tokens=128,
         stream_output=False,
+        mode="greedy",  # "greedy" or "sample" for low latency, "beam" for quality
+        output_scores=False,
         **kwargs,
     ):
         prompt = prompter.generate_prompt(instruction, input)
         inputs = tokenizer(prompt, return_tensors="pt")
         input_ids = inputs["input_ids"].to(device)
+        if mode not in ("greedy", "sample", "beam"):
+            raise ValueError(f"Unknown generation mode: {mode}")
+        # An explicit num_beams > 1 selects beam search in any mode (sampled within beams for "sample").
+        if mode == "beam" and num_beams <= 1:
+            num_beams = 4
+
         generation_config = GenerationConfig(
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
             num_beams=num_beams,
+            do_sample=mode == "sample",
             **kwargs,
         )
 
+        # Per-step scores are only kept when the caller asks for them.
         generate_params = {
             "input_ids": input_ids,
             "generation_config": generation_config,
-            "return_dict_in_generate": True,
-            "output_scores": True,
+            "return_dict_in_generate": output_scores,
+            "output_scores": output_scores,
             "max_new_tokens": max_new_tokens,
         }
 
@@ -134,27 +144,26 @@ def main(
                     generate_with_callback, kwargs, callback=None
                 )
 
+            # Only the newly generated tokens are decoded at each step.
+            decoder = IncrementalDecoder(tokenizer)
+            prompt_length = input_ids.shape[1]
             with generate_with_streaming(**generate_params) as generator:
                 for output in generator:
-                    # new_tokens = len(output) - len(input_ids[0])
-                    decoded_output = tokenizer.decode(output)
-
                     if output[-1] in [tokenizer.eos_token_id]:
                         break
 
-                    yield prompter.get_response(decoded_output)
+                    if num_beams > 1:
+                        # The best beam can change earlier tokens, so decode it from scratch.
+                        decoder.reset()
+                    if decoder.decode(output[prompt_length:]):
+                        yield decoder.text.strip()
             return  # early return for stream_output
 
         # Without streaming
         with torch.no_grad():
-            generation_output = model.generate(
-                input_ids=input_ids,
-                generation_config=generation_config,
-                return_dict_in_generate=True,
-                output_scores=True,
-                max_new_tokens=max_new_tokens,
-            )
-        s = generation_output.sequences[0]
+            generation_output = model.generate(**generate_params)
+        sequences = generation_output.sequences if output_scores else generation_output
+        s = sequences[0]
         output = tokenizer.decode(s)
         yield prompter.get_response(output)
 
@@ -177,12 +186,15 @@ def main(
                 minimum=0, maximum=100, step=1, value=40, label="Top k"
             ),
             gr.components.Slider(
-                minimum=1, maximum=4, step=1, value=4, label="Beams"
+                minimum=1, maximum=4, step=1, value=1, label="Beams"
             ),
             gr.components.Slider(
                 minimum=1, maximum=2000, step=1, value=128, label="Max tokens"
             ),
             gr.components.Checkbox(label="Stream output"),
+            gr.components.Radio(
+                choices=["greedy", "sample", "beam"], value="greedy", label="Mode"
+            ),
         ],
         outputs=[
             gr.inputs.Textbox(
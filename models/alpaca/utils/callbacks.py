@@ -73,3 +73,49 @@ class Iteratorize:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop_now = True
+
+
+class IncrementalDecoder:
+
+    """
+    Decodes a growing sequence of generated token ids, only looking at the
+    tokens added since the last call instead of the whole sequence.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.reset()
+
+    def reset(self):
+        self.token_ids = []
+        self.text = ""
+        # SentencePiece drops the leading space of the first decoded piece, so new
+        # tokens are decoded together with the ones before them (from prefix_offset)
+        # and only the text past the already emitted part (read_offset) is kept.
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def decode(self, token_ids):
+        """
+        Consumes `token_ids`, the whole generated sequence so far (list or tensor),
+        and returns the text delta.
+        """
+        self.token_ids.extend(int(token_id) for token_id in token_ids[len(self.token_ids):])
+
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        # An incomplete UTF-8 sequence (e.g. a byte-fallback emoji) waits for its remaining bytes.
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(
+            token_ids, skip_special_tokens=self.skip_special_tokens
+        )
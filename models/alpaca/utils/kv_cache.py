@@ -0,0 +1,86 @@
+"""
+Reuse of the key/value cache between prompts that share a token prefix.
+"""
+
+import threading
+from typing import Optional, Tuple
+
+import torch
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+class PrefixCache:
+
+    """
+    Keeps the key/value cache of the last prompt, so that the next prompt of the
+    same conversation only has to prefill the tokens after the common prefix.
+    """
+
+    def __init__(self):
+        self.input_ids: Optional[list] = None
+        self.past_key_values: Optional[PastKeyValues] = None
+        # Gradio calls a shared instance from several worker threads.
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.input_ids = None
+            self.past_key_values = None
+
+    def prefill(self, model, input_ids: torch.Tensor) -> Optional[PastKeyValues]:
+        """
+        Returns the cache for all tokens of `input_ids` (batch of one) except the
+        last, which generate() still has to process to produce the first logits.
+        """
+        with self.lock:
+            return self._prefill(model, input_ids)
+
+    def _prefill(self, model, input_ids: torch.Tensor) -> Optional[PastKeyValues]:
+        ids = input_ids[0].tolist()
+        target = len(ids) - 1
+        if target <= 0:
+            return None
+
+        reused = 0
+        if self.input_ids is not None:
+            reused = min(self._common_prefix(self.input_ids, ids), target)
+
+        past_key_values = self._crop(self.past_key_values, reused) if reused else None
+        if reused < target:
+            with torch.no_grad():
+                outputs = model(
+                    input_ids=input_ids[:, reused:target],
+                    attention_mask=torch.ones_like(input_ids[:, :target]),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+            past_key_values = self._to_legacy(outputs.past_key_values)
+
+        self.input_ids = ids[:target]
+        self.past_key_values = past_key_values
+        return past_key_values
+
+    @staticmethod
+    def _common_prefix(a: list, b: list) -> int:
+        length = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            length += 1
+        return length
+
+    @staticmethod
+    def _crop(past_key_values: PastKeyValues, length: int) -> PastKeyValues:
+        # Slicing keeps views of the cached tensors; generate() concatenates new
+        # entries into fresh tensors, so the cached ones are never modified.
+        return tuple(
+            (key[:, :, :length, :], value[:, :, :length, :])
+            for key, value in past_key_values
+        )
+
+    @staticmethod
+    def _to_legacy(past_key_values) -> PastKeyValues:
+        if hasattr(past_key_values, "to_legacy_cache"):
+            return past_key_values.to_legacy_cache()
+        return tuple(past_key_values)
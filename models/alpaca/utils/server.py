@@ -0,0 +1,155 @@
+"""
+A local generation server that runs prompts of concurrent sessions as one batch.
+"""
+
+import threading
+import time
+import traceback
+from queue import Empty, Queue
+from typing import Iterator, List
+
+import torch
+import transformers
+from transformers import GenerationConfig
+
+
+class GenerationRequest:
+    def __init__(self, input_ids: List[int], generation_config: GenerationConfig, max_new_tokens: int):
+        self.input_ids = input_ids
+        self.generation_config = generation_config
+        self.max_new_tokens = max_new_tokens
+        self.outputs = Queue()
+        self.done = False
+
+
+class BatchStream(transformers.StoppingCriteria):
+
+    """
+    Hands every row's generated tokens to its request after each step, and stops
+    generation once each request has reached its own end.
+    """
+
+    def __init__(self, requests: List[GenerationRequest], prompt_width: int, eos_token_id: int):
+        self.requests = requests
+        self.prompt_width = prompt_width
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        generated = input_ids[:, self.prompt_width:]
+        for row, request in enumerate(self.requests):
+            if request.done:
+                continue
+            token_ids = generated[row]
+            if token_ids[-1] == self.eos_token_id:
+                request.done = True
+                token_ids = token_ids[:-1]
+            elif len(token_ids) >= request.max_new_tokens:
+                request.done = True
+            request.outputs.put(token_ids)
+        return all(request.done for request in self.requests)
+
+
+class GenerationServer:
+
+    """
+    Queues prompts from concurrent sessions and generates them together as
+    left-padded batches, grouped by generation config. Each request streams its
+    own tokens and stops on its own EOS or token limit.
+    """
+
+    def __init__(
+        self,
+        model,
+        device: str,
+        pad_token_id: int = 0,
+        eos_token_id: int = 2,
+        window: float = 0.05,
+        max_batch_size: int = 8,
+    ):
+        self.model = model
+        self.device = device
+        self.pad_token_id = pad_token_id
+        self.eos_token_id = eos_token_id
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue = Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.sentinel = object()
+
+    def generate(
+        self,
+        input_ids: List[int],
+        generation_config: GenerationConfig,
+        max_new_tokens: int = 128,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Yields the generated token ids of the prompt (without the prompt) after each step.
+        """
+        request = GenerationRequest(list(input_ids), generation_config, max_new_tokens)
+        self.queue.put(request)
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="generation-server", daemon=True)
+                self.thread.start()
+
+        try:
+            while True:
+                output = request.outputs.get()
+                if output is self.sentinel:
+                    return
+                if isinstance(output, Exception):
+                    raise output
+                yield output
+        finally:
+            # A caller that stops reading frees its row for the rest of the batch.
+            request.done = True
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.generation_config.to_json_string(), []).append(request)
+
+            for requests in groups.values():
+                try:
+                    self._generate_batch(requests)
+                except Exception as e:
+                    traceback.print_exc()
+                    for request in requests:
+                        request.outputs.put(e)
+                for request in requests:
+                    request.outputs.put(self.sentinel)
+
+    def _generate_batch(self, requests: List[GenerationRequest]) -> None:
+        width = max(len(request.input_ids) for request in requests)
+        input_ids = torch.full((len(requests), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), width), dtype=torch.long)
+        for row, request in enumerate(requests):
+            length = len(request.input_ids)
+            input_ids[row, width - length:] = torch.tensor(request.input_ids, dtype=torch.long)
+            attention_mask[row, width - length:] = 1
+
+        with torch.no_grad():
+            self.model.generate(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                generation_config=requests[0].generation_config,
+                max_new_tokens=max(request.max_new_tokens for request in requests),
+                stopping_criteria=transformers.StoppingCriteriaList([
+                    BatchStream(requests, width, self.eos_token_id),
+                ]),
+                pad_token_id=self.pad_token_id,
+            )
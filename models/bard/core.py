@@ -1,8 +1,10 @@
 import os
+import asyncio
+from queue import Empty, Queue
 import gradio as gr
-import requests
 from bardapi import Bard as BardAPI, SESSION_HEADERS
 from utils.model import Model
+from utils.clients import get_client, get_client_config, get_requests_session
 
 class Bard(Model):
     def __init__(
@@ -16,26 +18,51 @@ class Bard(Model):
             self.api_key
         ), "Please specify an --bard_api_key"
 
-        self.session = requests.Session()
+        self.session = get_requests_session("bard", self.api_key)
         self.session.headers = SESSION_HEADERS
         self.session.cookies.set("__Secure-1PSID", self.api_key)
         self.session.cookies.set("__Secure-1PSIDTS", "")
         # session.cookies.set("__Secure-1PSIDCC", "")
 
-        self.setup_interface(self.prompt, self.get_inputs(), self.get_outputs())
+        # Creating a BardAPI fetches a page token, so idle instances are pooled and
+        # reused; the pool grows to the number of concurrent calls.
+        self.pool = get_client("bard-pool", self.api_key, Queue)
+
+        self.setup_interface(self.prompt, self.get_inputs(), self.get_outputs(), afn=self.aprompt)
 
     def prompt(
         self,
         input,
     ):
-        chat = BardAPI(
-            token=self.api_key,
-            session=self.session,
-        )
-        response = chat.get_answer(input)
+        chat = self.__checkout()
+        try:
+            # Every prompt starts a new conversation, as with a fresh BardAPI.
+            chat.conversation_id = ""
+            chat.response_id = ""
+            chat.choice_id = ""
+            response = chat.get_answer(input)
+        finally:
+            self.pool.put(chat)
         reply = response['content']
 
         return reply
+
+    async def aprompt(
+        self,
+        input,
+    ):
+        # bardapi only offers a blocking client.
+        return await asyncio.to_thread(self.prompt, input)
+
+    def __checkout(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            return BardAPI(
+                token=self.api_key,
+                session=self.session,
+                timeout=get_client_config().timeout,
+            )
         
     def get_inputs(self):
         return [
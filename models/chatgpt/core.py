@@ -2,7 +2,9 @@ import os
 import openai
 import gradio as gr
 import math
-from utils.model import Model
+from utils.model import Model, aiter_of
+from utils.cache import ResponseCache, get_completion_cache
+from utils.clients import get_aiohttp_session, get_client_config, get_requests_session
 
 class ChatGPT(Model):
     def __init__(
@@ -10,19 +12,24 @@ class ChatGPT(Model):
         api_key: str = "",
         model: str = "gpt-3.5-turbo",
         context: bool = True,
+        cache: ResponseCache = None,
     ):
         super().__init__()
 
-        openai.api_key = api_key or os.getenv("OPENAI_API_KEY", "")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY", "")
         assert (
-            openai.api_key
+            self.api_key
         ), "Please specify an --openai_api_key"
 
+        # Keep-alive connections are pooled across all threads and sessions.
+        openai.requestssession = get_requests_session("openai")
+
         self.model = model
         self.messages = []
         self.context = context
+        self.cache = cache if cache is not None else get_completion_cache()
 
-        self.setup_interface(self.prompt, self.get_inputs(), self.get_outputs())
+        self.setup_interface(self.prompt, self.get_inputs(), self.get_outputs(), afn=self.aprompt)
 
     def prompt(
         self,
@@ -33,6 +40,59 @@ class ChatGPT(Model):
         presence_penalty=0, # -2.0~2.0
         stop=[], # up to 4 sequences
         history=None,
+        stream=False,
+    ):
+        params, cache_key, reply = self.__prepare(
+            input, temperature, top_p, frequency_penalty, presence_penalty, stop, history,
+        )
+        if reply is not None:
+            return iter([reply]) if stream else reply
+
+        if stream:
+            return self.__stream(params, cache_key)
+
+        chat = openai.ChatCompletion.create(**params, **self.__request_options())
+        role = chat.choices[0].message.role
+        reply = chat.choices[0].message.content
+
+        return self.__finish(role, reply, cache_key) # Without streaming
+
+    async def aprompt(
+        self,
+        input,
+        temperature=0.7, # 0~2.0
+        top_p=1.0,
+        frequency_penalty=0, # -2.0~2.0
+        presence_penalty=0, # -2.0~2.0
+        stop=[], # up to 4 sequences
+        history=None,
+        stream=False,
+    ):
+        params, cache_key, reply = self.__prepare(
+            input, temperature, top_p, frequency_penalty, presence_penalty, stop, history,
+        )
+        if reply is not None:
+            return aiter_of([reply]) if stream else reply
+
+        if stream:
+            return self.__astream(params, cache_key)
+
+        self.__use_aiosession()
+        chat = await openai.ChatCompletion.acreate(**params, **self.__request_options())
+        role = chat.choices[0].message.role
+        reply = chat.choices[0].message.content
+
+        return self.__finish(role, reply, cache_key)
+
+    def __prepare(
+        self,
+        input,
+        temperature,
+        top_p,
+        frequency_penalty,
+        presence_penalty,
+        stop,
+        history,
     ):
         message = {
             "role": "user",
@@ -40,31 +100,83 @@ class ChatGPT(Model):
         }
 
         if type(history) is list:
-            self.messages = history + [message]
+            messages = history + [message]
         elif self.context:
-            self.messages.append(message)
+            messages = self.messages + [message]
         else:
-            self.messages = [message]
+            messages = [message]
 
-        chat = openai.ChatCompletion.create(
+        # Without context the instance keeps no state and can be shared between sessions.
+        if self.context:
+            self.messages = messages
+
+        params = dict(
             model=self.model,
-            messages=self.messages,
+            messages=messages,
             temperature=temperature,
             top_p=top_p,
             frequency_penalty=frequency_penalty,
             presence_penalty=presence_penalty,
             stop=stop,
         )
-        role = chat.choices[0].message.role
-        reply = chat.choices[0].message.content
+
+        # Only deterministic completions are cached.
+        cache_key = None
+        reply = None
+        if temperature == 0:
+            cache_key = ResponseCache.make_key(provider="openai", **params)
+            reply = self.cache.get(cache_key)
+            if reply is not None:
+                self.__finish("assistant", reply)
+        return params, cache_key, reply
+
+    def __finish(self, role, reply, cache_key=None):
+        if cache_key is not None:
+            self.cache.set(cache_key, reply)
 
         if self.context:
             self.messages.append({
                 "role": role,
                 "content": reply,
             })
+        return reply
+
+    def __request_options(self):
+        return {
+            "api_key": self.api_key,
+            "request_timeout": get_client_config().timeout,
+        }
+
+    def __use_aiosession(self):
+        # Without it, every acreate opens and closes its own aiohttp session.
+        openai.aiosession.set(get_aiohttp_session("openai"))
+
+    def __stream(self, params, cache_key=None):
+        role = "assistant"
+        reply = ""
+        for chunk in openai.ChatCompletion.create(**params, **self.__request_options(), stream=True):
+            delta = chunk.choices[0].delta
+            role = delta.get("role", role)
+            content = delta.get("content")
+            if content:
+                reply += content
+                yield content
+
+        self.__finish(role, reply, cache_key)
+
+    async def __astream(self, params, cache_key=None):
+        role = "assistant"
+        reply = ""
+        self.__use_aiosession()
+        async for chunk in await openai.ChatCompletion.acreate(**params, **self.__request_options(), stream=True):
+            delta = chunk.choices[0].delta
+            role = delta.get("role", role)
+            content = delta.get("content")
+            if content:
+                reply += content
+                yield content
 
-        return reply # Without streaming
+        self.__finish(role, reply, cache_key)
         
     def get_inputs(self):
         return [
@@ -1,35 +1,108 @@
 import os
+import asyncio
 import gradio as gr
-import tempfile
 import base64
+import typing
 from google.cloud import texttospeech
 
 from utils.model import Model
+from utils.cache import ResponseCache, get_speech_cache
+from utils.clients import get_client, get_client_config
 
 class GoogleTTS(Model):
     def __init__(
         self,
         api_key: str = "",
+        voice_name: str = "en-US-Wavenet-G",
+        cache: ResponseCache = None,
     ):
         self.api_key = api_key or os.getenv("GOOGLE_TTS_API_KEY", "")
-        self.setup_interface(self.synthesize, self.get_inputs(), self.get_outputs())
+        self.voice_name = voice_name
+        self.cache = cache if cache is not None else get_speech_cache()
+        self.setup_interface(self.synthesize, self.get_inputs(), self.get_outputs(), afn=self.asynthesize)
         
     def synthesize(
         self,
         text: str,
         language_code: str = "en-US",
+        output_format: str = "base64",  # or "bytes" / "memoryview" for the raw audio
     ):
-        audio_file = tempfile.NamedTemporaryFile(delete=True, suffix=".mp3")
+        cache_key = self.__cache_key(text, language_code)
+        audio_content = self.cache.get(cache_key)
+        if audio_content is not None:
+            return self.__format_audio(audio_content, output_format)
 
-        client = texttospeech.TextToSpeechClient(
+        # The client keeps its gRPC channel open and is shared by all calls.
+        client = get_client("googletts", self.api_key, lambda: texttospeech.TextToSpeechClient(
             client_options={ "api_key": self.api_key }
+        ))
+
+        response = client.synthesize_speech(
+            request=self.__request(text, language_code),
+            timeout=get_client_config().timeout,
         )
+        self.cache.set(cache_key, response.audio_content)
+
+        return self.__format_audio(response.audio_content, output_format)
+
+    async def asynthesize(
+        self,
+        text: str,
+        language_code: str = "en-US",
+        output_format: str = "base64",
+    ):
+        cache_key = self.__cache_key(text, language_code)
+        audio_content = self.cache.get(cache_key)
+        if audio_content is not None:
+            return self.__format_audio(audio_content, output_format)
 
+        # Async gRPC channels are bound to the event loop that created them.
+        loop = asyncio.get_running_loop()
+        client = get_client("googletts-async", (self.api_key, id(loop)), lambda: texttospeech.TextToSpeechAsyncClient(
+            client_options={ "api_key": self.api_key }
+        ))
+
+        response = await client.synthesize_speech(
+            request=self.__request(text, language_code),
+            timeout=get_client_config().timeout,
+        )
+        self.cache.set(cache_key, response.audio_content)
+
+        return self.__format_audio(response.audio_content, output_format)
+
+    def prewarm(
+        self,
+        phrases: typing.Iterable[str],
+        language_code: str = "en-US",
+    ) -> None:
+        # Synthesizes recurring system phrases ahead of time so they are served from the cache.
+        for phrase in phrases:
+            if self.__cache_key(phrase, language_code) not in self.cache:
+                self.synthesize(phrase, language_code)
+
+    def __cache_key(
+        self,
+        text: str,
+        language_code: str,
+    ) -> str:
+        return ResponseCache.make_key(
+            provider="googletts",
+            text=text,
+            voice=self.voice_name,
+            language_code=language_code,
+            encoding="MP3",
+        )
+
+    def __request(
+        self,
+        text: str,
+        language_code: str,
+    ) -> dict:
         input_text = texttospeech.SynthesisInput(text=text)
 
         voice = texttospeech.VoiceSelectionParams(
             language_code=language_code,
-            name=f"en-US-Wavenet-G",
+            name=self.voice_name,
             ssml_gender=texttospeech.SsmlVoiceGender.FEMALE,
         )
 
@@ -37,16 +110,7 @@ class GoogleTTS(Model):
             audio_encoding=texttospeech.AudioEncoding.MP3
         )
 
-        response = client.synthesize_speech(
-            request={"input": input_text, "voice": voice, "audio_config": audio_config}
-        )
-        
-        with open(audio_file.name, "wb") as out:
-            out.write(response.audio_content)
-
-        speech_base64 = self.__audio_to_base64(audio_file.name)
-
-        return speech_base64
+        return {"input": input_text, "voice": voice, "audio_config": audio_config}
         
     def get_inputs(self):
         return [
@@ -61,7 +125,16 @@ class GoogleTTS(Model):
             ),
         ]
     
-    def __audio_to_base64(self, audio_filepath: str) -> str:
-        with open(audio_filepath, "rb") as audio_file:
-            audio_encoded = base64.b64encode(audio_file.read())
-        return audio_encoded.decode("utf-8")
+    def __format_audio(
+        self,
+        audio_content: bytes,
+        output_format: str,
+    ) -> typing.Union[str, bytes, memoryview]:
+        # The audio is encoded straight from the response, without touching the disk.
+        if output_format == "base64":
+            return base64.b64encode(audio_content).decode("ascii")
+        if output_format == "bytes":
+            return audio_content
+        if output_format == "memoryview":
+            return memoryview(audio_content)
+        raise ValueError(f"Unsupported output format: {output_format}")
@@ -1,7 +1,11 @@
 import os
+import asyncio
+import json
 import gradio as gr
 import google.generativeai as palm
 from utils.model import Model
+from utils.cache import ResponseCache, get_completion_cache
+from utils.clients import get_client
 
 class PaLM(Model):
     def __init__(
@@ -9,6 +13,7 @@ class PaLM(Model):
         api_key: str = "",
         model: str = "models/chat-bison-001",
         context: bool = True,
+        cache: ResponseCache = None,
     ):
         super().__init__()
         
@@ -16,14 +21,16 @@ class PaLM(Model):
         assert (
             self.api_key
         ), "Please specify an --google_api_key"
-        palm.configure(api_key=self.api_key)
+        # configure() replaces the global API clients, so it runs once per key.
+        get_client("palm", self.api_key, lambda: palm.configure(api_key=self.api_key) or True)
 
         self.model_name = model
-        self.model = palm.get_model(model)
+        self.model = get_client("palm-model", (self.api_key, model), lambda: palm.get_model(model))
         self.messages = []
         self.context = context
+        self.cache = cache if cache is not None else get_completion_cache()
 
-        self.setup_interface(self.prompt, self.get_inputs(), self.get_outputs())
+        self.setup_interface(self.prompt, self.get_inputs(), self.get_outputs(), afn=self.aprompt)
 
     def prompt(
         self,
@@ -33,6 +40,7 @@ class PaLM(Model):
         top_k=40,
         stop=[],
         history=None,
+        stream=False,
     ):
         message = {
             "author": "user",
@@ -40,16 +48,41 @@ class PaLM(Model):
         }
 
         if type(history) is list:
-            self.messages = history + [message]
+            messages = history + [message]
         elif self.context:
-            self.messages.append(message)
+            messages = self.messages + [message]
         else:
-            self.messages = [message]
+            messages = [message]
 
-        if self.model_name == "models/chat-bison-001":
+        # Without context the instance keeps no state and can be shared between sessions.
+        if self.context:
+            self.messages = messages
+
+        # Only deterministic completions are cached.
+        cache_key = None
+        reply = None
+        if temperature == 0:
+            cache_key = ResponseCache.make_key(
+                provider="palm",
+                model=self.model_name,
+                messages=messages if self.model_name == "models/chat-bison-001" else input,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                stop=stop,
+                entry="message",  # author and content, as JSON
+            )
+            entry = self.cache.get(cache_key)
+            if entry is not None:
+                # The author is cached with the reply, so the history is the same either way.
+                entry = json.loads(entry)
+                author, reply = entry["author"], entry["content"]
+
+        cached = reply is not None
+        if not cached and self.model_name == "models/chat-bison-001":
             chat = palm.chat(
                 model=self.model,
-                messages=self.messages,
+                messages=messages,
                 temperature=temperature,
                 top_p=top_p,
                 top_k=top_k,
@@ -57,7 +90,7 @@ class PaLM(Model):
             print(chat)
             author = chat.messages[-1]['author']
             reply = chat.messages[-1]['content']
-        else:
+        elif not cached:
             author = "assistant"
             reply = palm.generate_text(
                 model=self.model,
@@ -69,13 +102,24 @@ class PaLM(Model):
             )
             reply = reply.result
 
+        if cache_key is not None and not cached and reply is not None:
+            self.cache.set(cache_key, json.dumps({"author": author, "content": reply}))
+
         if self.context:
             self.messages.append({
                 "author": author,
                 "content": reply
             })
 
+        if stream:
+            # The PaLM API has no streaming endpoint; the reply arrives as a single chunk.
+            return iter([reply])
         return reply
+
+    async def aprompt(self, *args, **kwargs):
+        # generate_text has no async variant in google.generativeai, so the
+        # blocking call runs on a worker thread instead of the event loop.
+        return await asyncio.to_thread(self.prompt, *args, **kwargs)
     
     def get_inputs(self):
         return [
@@ -1,7 +1,15 @@
 import gc
+import time
+import threading
 import gradio as gr
 import torch
 import whisperx
+from collections import OrderedDict
+from concurrent.futures import Future
+from faster_whisper.tokenizer import Tokenizer
+from queue import Empty, Queue
+from whisperx.audio import SAMPLE_RATE
+from whisperx.vad import merge_chunks
 
 from utils.model import Model
 
@@ -13,6 +21,11 @@ class WhisperX(Model):
         model_name: str = "large-v2",
         compute_type: str = "float16",  # reduce if low on GPU mem
         batch_size: int = 16,
+        keep_models_loaded: bool = True,  # set False if low on memory to load models per request
+        align_cache_size: int = 2,  # number of languages whose alignment models stay loaded
+        align: bool = False,  # word-level timestamps are only needed when aligning
+        batch_window: float = 0.0,  # seconds to wait for concurrent requests to batch together
+        max_batch_requests: int = 8,
     ):
         # 1. Transcribe with original whisper (batched)
         self.device = device
@@ -20,9 +33,23 @@ class WhisperX(Model):
         self.model_name = model_name
         self.compute_type = compute_type
         self.batch_size = batch_size
+        self.keep_models_loaded = keep_models_loaded
+        self.align_cache_size = align_cache_size
+        self.align = align
+
+        self.model = None
+        self.align_models = OrderedDict()
+        self.lock = threading.RLock()
+        self.batcher = None
+        if batch_window > 0:
+            self.batcher = TranscriptionBatcher(
+                self.transcribe_batch,
+                window=batch_window,
+                max_batch_size=max_batch_requests,
+            )
 
         self.setup_interface(self.transcribe, self.get_inputs(), self.get_outputs())
-        
+
     def transcribe(
         self,
         audio_from_mic: str = None,
@@ -34,30 +61,151 @@ class WhisperX(Model):
             return text_input
 
         audio_input = audio_from_mic or audio_file
+        if self.batcher is not None and not self.align:
+            # Decoding runs on the calling thread; only the model call is batched.
+            segments = self.batcher.submit(whisperx.load_audio(audio_input), language).result()
+        else:
+            segments = self.transcribe_segments(audio_input, language=language)
+
+        text_list = [data['text'].strip() + "\n" for data in segments]
+        text = "".join(text_list).rstrip()
+        return text
+
+    def transcribe_segments(
+        self,
+        audio_input: str,
+        language: str = "en",
+        align: bool = None,
+    ) -> list[dict]:
+        if align is None:
+            align = self.align
 
-        # 1. Transcribe with original whisper (batched)
         audio = whisperx.load_audio(audio_input)
+
+        with self.lock:
+            # 1. Transcribe with original whisper (batched)
+            model = self.__get_model()
+            result = model.transcribe(audio, batch_size=self.batch_size, language=language)
+
+            # delete model if low on GPU resources
+            del model
+            if self.model is None:
+                self.__free_memory()
+
+            if not align:
+                return result["segments"]
+
+            # 2. Align whisper output
+            align_language = result['language'] if language is None else language
+            align_model, metadata = self.__get_align_model(align_language)
+            result = whisperx.align(result["segments"], align_model, metadata, audio, self.device, return_char_alignments=False)
+
+            # delete model if low on GPU resources
+            del align_model
+            if align_language not in self.align_models:
+                self.__free_memory()
+
+        return result["segments"]
+
+    def transcribe_batch(
+        self,
+        audio_inputs: list,  # file paths or already loaded waveforms
+        language: str = "en",
+    ) -> list[list[dict]]:
+        audios = [
+            whisperx.load_audio(audio_input) if isinstance(audio_input, str) else audio_input
+            for audio_input in audio_inputs
+        ]
+
+        with self.lock:
+            model = self.__get_model()
+
+            if language is None:
+                # Each request needs its own language detection.
+                results = [model.transcribe(audio, batch_size=self.batch_size)["segments"] for audio in audios]
+            else:
+                results = self.__transcribe_coalesced(model, audios, language)
+
+            # delete model if low on GPU resources
+            del model
+            if self.model is None:
+                self.__free_memory()
+
+        return results
+
+    def __transcribe_coalesced(self, model, audios: list, language: str) -> list[list[dict]]:
+        # Runs the voice activity chunks of every request through one batched call.
+        # transcribe() drops its tokenizer after each call unless the model was
+        # loaded with a language, so the call gets its own.
+        tokenizer = model.tokenizer
+        model.tokenizer = Tokenizer(
+            model.model.hf_tokenizer,
+            model.model.model.is_multilingual,
+            task="transcribe",
+            language=language,
+        )
+        try:
+            return self.__run_coalesced(model, audios)
+        finally:
+            model.tokenizer = tokenizer
+
+    def __run_coalesced(self, model, audios: list) -> list[list[dict]]:
+        vad_params = getattr(model, "_vad_params", {"vad_onset": 0.500, "vad_offset": 0.363})
+        chunks = []
+        for index, audio in enumerate(audios):
+            vad_segments = model.vad_model({"waveform": torch.from_numpy(audio).unsqueeze(0), "sample_rate": SAMPLE_RATE})
+            vad_segments = merge_chunks(
+                vad_segments,
+                30,
+                onset=vad_params["vad_onset"],
+                offset=vad_params["vad_offset"],
+            )
+            chunks.extend((index, segment["start"], segment["end"]) for segment in vad_segments)
+
+        def data():
+            for index, start, end in chunks:
+                yield {"inputs": audios[index][int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]}
+
+        results = [[] for _ in audios]
+        outputs = model(data(), batch_size=self.batch_size, num_workers=0)
+        for (index, start, end), output in zip(chunks, outputs):
+            text = output["text"]
+            if self.batch_size in [0, 1, None]:
+                text = text[0]
+            results[index].append({
+                "text": text,
+                "start": round(start, 3),
+                "end": round(end, 3),
+            })
+        return results
+
+    def __get_model(self):
+        if self.model is not None:
+            return self.model
+
         model = whisperx.load_model(self.model_name, self.device, device_index=self.device_index, compute_type=self.compute_type)
-        result = model.transcribe(audio, batch_size=self.batch_size, language=language)
+        if self.keep_models_loaded:
+            self.model = model
+        return model
 
-        # delete model if low on GPU resources
-        del model
-        gc.collect()
-        torch.cuda.empty_cache()
+    def __get_align_model(self, language: str):
+        if language in self.align_models:
+            self.align_models.move_to_end(language)
+            return self.align_models[language]
 
-        # 2. Align whisper output
-        align_model, metadata = whisperx.load_align_model(language_code=result['language'] if language is None else language, device=self.device)
-        result = whisperx.align(result["segments"], align_model, metadata, audio, self.device, return_char_alignments=False)
+        align_model, metadata = whisperx.load_align_model(language_code=language, device=self.device)
+        if self.keep_models_loaded and self.align_cache_size > 0:
+            self.align_models[language] = (align_model, metadata)
+            while len(self.align_models) > self.align_cache_size:
+                self.align_models.popitem(last=False)
+                self.__free_memory()
+        return align_model, metadata
 
-        # delete model if low on GPU resources
-        del align_model
+    def __free_memory(self) -> None:
         gc.collect()
-        torch.cuda.empty_cache()
-        
-        text_list = [data['text'].strip() + "\n" for data in result["segments"]]
-        text = "".join(text_list).rstrip()
-        return text
-        
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     def get_inputs(self):
         return [
             gr.components.Audio(
@@ -87,3 +235,65 @@ class WhisperX(Model):
                 label="Transcript",
             )
         ]
+
+class TranscriptionBatcher:
+    def __init__(
+        self,
+        transcribe_batch,
+        window: float = 0.05,
+        max_batch_size: int = 8,
+    ):
+        self.transcribe_batch = transcribe_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue = Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(
+        self,
+        audio,  # waveform loaded with whisperx.load_audio
+        language: str = "en",
+    ) -> Future:
+        future = Future()
+        self.queue.put((audio, language, future))
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name="transcription-batcher", daemon=True)
+                self.thread.start()
+        return future
+
+    def __run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request[1], []).append(request)
+
+            for language, requests in groups.items():
+                try:
+                    results = self.transcribe_batch([audio for audio, _, _ in requests], language)
+                except Exception as e:
+                    if len(requests) == 1:
+                        requests[0][2].set_exception(e)
+                        continue
+                    # Retry one by one, so a request that breaks the batch only fails itself.
+                    for audio, _, future in requests:
+                        try:
+                            future.set_result(self.transcribe_batch([audio], language)[0])
+                        except Exception as e:
+                            future.set_exception(e)
+                    continue
+                for (_, _, future), segments in zip(requests, results):
+                    future.set_result(segments)
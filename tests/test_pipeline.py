@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("gradio")
+
+from utils.model import Model
+from utils.pipeline import Pipeline
+
+
+class FakeModel(Model):
+    def __init__(self, fn):
+        super().__init__()
+        self.setup_interface(fn, [], [])
+
+
+def fake_transcribe(audio):
+    return "hello"
+
+
+def fake_generate(transcript, stream=False):
+    return iter(["First sentence. ", "Second", " sentence! ", "Third one"])
+
+
+def fake_synthesize(text, output_format="base64"):
+    assert output_format == "bytes"
+    return f"<{text}>".encode()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_stream_delivers_every_speech_chunk_in_order():
+    pipeline = Pipeline(
+        transcribe_model=FakeModel(fake_transcribe),
+        generate_model=FakeModel(fake_generate),
+        synthesize_model=FakeModel(fake_synthesize),
+        stream=True,
+    )
+
+    outputs = list(pipeline.stream("audio.wav"))
+    chunks = [read(speech) for _, _, speech in outputs if speech is not None]
+
+    assert outputs[-1][1] == "First sentence. Second sentence! Third one"
+    assert chunks == [b"<First sentence.>", b"<Second sentence!>", b"<Third one>"]
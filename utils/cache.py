@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import typing
+from collections import OrderedDict
+
+class ResponseCache:
+    # Content-addressed cache with an in-memory LRU tier and an optional SQLite tier.
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        path: typing.Optional[str] = None,
+        table: str = "responses",
+    ) -> None:
+        self.max_entries = max_entries
+        self.table = table
+        self.entries: OrderedDict[str, typing.Any] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(
+        self,
+        key: str,
+    ) -> typing.Any:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            if self.db is None:
+                return None
+            row = self.db.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.__remember(key, row[0])
+            return row[0]
+
+    def set(
+        self,
+        key: str,
+        value: typing.Any,
+    ) -> None:
+        with self.lock:
+            self.__remember(key, value)
+            if self.db is not None:
+                self.db.execute(f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", (key, value))
+                self.db.commit()
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __remember(
+        self,
+        key: str,
+        value: typing.Any,
+    ) -> None:
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+def get_completion_cache() -> ResponseCache:
+    # Shared by all model adapters; set COMPLETION_CACHE_PATH to persist completions.
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            _completion_cache = ResponseCache(
+                max_entries=int(os.getenv("COMPLETION_CACHE_SIZE", "1024")),
+                path=os.getenv("COMPLETION_CACHE_PATH") or None,
+                table="completions",
+            )
+    return _completion_cache
+
+_speech_cache = None
+_speech_cache_lock = threading.Lock()
+
+def get_speech_cache() -> ResponseCache:
+    # Synthesized audio keyed by text and voice; set SPEECH_CACHE_PATH to persist it.
+    global _speech_cache
+    with _speech_cache_lock:
+        if _speech_cache is None:
+            _speech_cache = ResponseCache(
+                max_entries=int(os.getenv("SPEECH_CACHE_SIZE", "256")),
+                path=os.getenv("SPEECH_CACHE_PATH") or None,
+                table="speech",
+            )
+    return _speech_cache
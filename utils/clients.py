@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import typing
+import requests
+from dataclasses import dataclass, replace
+from requests.adapters import HTTPAdapter
+
+@dataclass
+class ClientConfig:
+    pool_connections: int = 10  # number of hosts with pooled connections
+    pool_maxsize: int = 32  # keep-alive connections per host
+    timeout: float = 60.0  # seconds per request
+    max_retries: int = 2
+
+_config = ClientConfig()
+_clients: typing.Dict[tuple, typing.Any] = {}
+_clients_lock = threading.Lock()
+
+def configure_clients(**kwargs) -> ClientConfig:
+    # Clients created afterwards use the new settings.
+    global _config
+    with _clients_lock:
+        _config = replace(_config, **kwargs)
+        _clients.clear()
+    return _config
+
+def get_client_config() -> ClientConfig:
+    return _config
+
+def get_client(
+    provider: str,
+    key: typing.Hashable,
+    factory: typing.Callable[[], typing.Any],
+) -> typing.Any:
+    # One client per provider and key, reused by every call and session.
+    client = _clients.get((provider, key))
+    if client is None:
+        with _clients_lock:
+            client = _clients.get((provider, key))
+            if client is None:
+                client = factory()
+                _clients[(provider, key)] = client
+    return client
+
+def get_requests_session(
+    provider: str,
+    key: typing.Hashable = None,
+) -> requests.Session:
+    def create_session() -> requests.Session:
+        adapter = HTTPAdapter(
+            pool_connections=_config.pool_connections,
+            pool_maxsize=_config.pool_maxsize,
+            max_retries=_config.max_retries,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    return get_client(f"{provider}:requests", key, create_session)
+
+def get_aiohttp_session(
+    provider: str,
+    key: typing.Hashable = None,
+):
+    # aiohttp sessions are bound to the event loop that created them.
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+
+    def create_session():
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=_config.pool_maxsize),
+        )
+
+    return get_client(f"{provider}:aiohttp", (key, id(loop)), create_session)
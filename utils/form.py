@@ -14,7 +14,7 @@ class Form:
     def _create_form(self) -> gr.Blocks:
         with gr.Blocks() as form:
             gr.Interface(
-                fn=self.model.fn,
+                fn=self.model.afn or self.model.fn,
                 inputs=self.model.inputs,
                 outputs=self.model.outputs,
                 title=self.title,
@@ -40,7 +40,7 @@ class PairwiseForm(Form):
     def _create_form(self) -> gr.Blocks:
         with gr.Blocks() as form:
             gr.Interface(
-                fn=self.model.fn,
+                fn=self.model.afn or self.model.fn,
                 inputs=self.model.inputs,
                 outputs=self.model.outputs,
                 title=self.title,
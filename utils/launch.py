@@ -1,4 +1,7 @@
 import os
+import threading
+import time
+import typing
 import torch
 import gradio as gr
 from dataclasses import dataclass
@@ -12,6 +15,11 @@ class LaunchConfig:
     server_port: int = 443
     share_gradio: bool = False
     http: bool = False
+    concurrency_count: int = 16  # queue workers processing events in parallel
+    max_queue_size: typing.Optional[int] = None  # further requests are rejected
+    asr_concurrency: typing.Optional[int] = None  # in-flight transcriptions
+    llm_concurrency: typing.Optional[int] = None  # in-flight LLM calls
+    queue_report_interval: float = 60.0  # seconds between queue depth logs, 0 to disable
 
 class Launcher:
     def __init__(self):
@@ -41,6 +49,7 @@ class Launcher:
         model: Model,
         config: LaunchConfig,
         form: type[Form] = Form,
+        form_kwargs: typing.Optional[dict] = None,
     ) -> tuple:
         if config.http:
             self.__SSL_CERT_PATH = None
@@ -50,15 +59,58 @@ class Launcher:
 
         if form is None:
             form = Form
+        # Gradio 3 has no per-event concurrency limits, so the pipeline enforces them.
+        for name in ("asr", "llm"):
+            limit = getattr(model, f"{name}_limit", None)
+            if limit is not None:
+                limit.set_limit(getattr(config, f"{name}_concurrency"))
+
         instance = form(
             model=model,
             title=config.title,
+            **(form_kwargs or {}),
         ).get_form()
 
-        return instance.queue().launch(
+        instance.queue(
+            concurrency_count=config.concurrency_count,
+            max_size=config.max_queue_size,
+        )
+        if config.queue_report_interval > 0:
+            self.__report_queue_depth(instance, model, config.queue_report_interval)
+
+        return instance.launch(
             server_name=config.server_name,
             server_port=config.server_port,
             share=config.share_gradio,
             ssl_certfile=self.__SSL_CERT_PATH,
             ssl_keyfile=self.__SSL_KEY_PATH,
         )
+
+    @staticmethod
+    def get_queue_depth(
+        instance: gr.Blocks,
+        model: Model,
+    ) -> dict:
+        depth = {}
+        queue = getattr(instance, "_queue", None)
+        if queue is not None:
+            depth["queued"] = len(getattr(queue, "event_queue", []))
+            depth["processing"] = sum(event is not None for event in getattr(queue, "active_jobs", []))
+        for name in ("asr", "llm"):
+            limit = getattr(model, f"{name}_limit", None)
+            if limit is not None:
+                depth[name] = limit.stats()
+        return depth
+
+    def __report_queue_depth(
+        self,
+        instance: gr.Blocks,
+        model: Model,
+        interval: float,
+    ) -> None:
+        def report() -> None:
+            while True:
+                time.sleep(interval)
+                print(f"Queue depth: {self.get_queue_depth(instance, model)}")
+
+        threading.Thread(target=report, name="queue-report", daemon=True).start()
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import typing
+from collections import deque
+
+class ConcurrencyLimit:
+    # Caps the in-flight calls of one kind (e.g. ASR or LLM) across all sessions.
+    # Usable from threads (with) and from the event loop (async with); both share
+    # one counter, and None means unlimited.
+    def __init__(
+        self,
+        name: str,
+        limit: typing.Optional[int] = None,
+    ) -> None:
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+        self.async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    def set_limit(
+        self,
+        limit: typing.Optional[int],
+    ) -> None:
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+            while self.async_waiters:
+                self.__wake_async()
+
+    def __enter__(self) -> "ConcurrencyLimit":
+        with self.condition:
+            self.waiting += 1
+            try:
+                self.condition.wait_for(self.__available)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.__release()
+
+    async def __aenter__(self) -> "ConcurrencyLimit":
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.__available():
+                    self.active += 1
+                    return self
+                future = loop.create_future()
+                waiter = (loop, future)
+                self.async_waiters.append(waiter)
+                self.waiting += 1
+
+            try:
+                await future
+            except BaseException:
+                with self.condition:
+                    if waiter in self.async_waiters:
+                        self.async_waiters.remove(waiter)
+                    else:
+                        # Woken but cancelled before taking the slot; pass the wake-up on.
+                        self.__wake_async()
+                raise
+            finally:
+                with self.condition:
+                    self.waiting -= 1
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.__release()
+
+    def stats(self) -> dict:
+        return {"active": self.active, "waiting": self.waiting, "limit": self.limit}
+
+    def __available(self) -> bool:
+        return not self.limit or self.active < self.limit
+
+    def __release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            # Wake one waiter of each kind; whichever loses the race waits again.
+            self.condition.notify()
+            self.__wake_async()
+
+    def __wake_async(self) -> None:
+        if not self.async_waiters:
+            return
+        loop, future = self.async_waiters.popleft()
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
@@ -1,10 +1,15 @@
+import asyncio
 import gradio as gr
+import threading
 import typing
 
 class Model:
+    afn = None
+
     def __init__(self) -> None:
         self.inputs = []
         self.fn = None
+        self.afn = None
         self.outputs = []
     
     def setup_interface(
@@ -12,10 +17,61 @@ class Model:
         fn: typing.Callable,
         inputs: typing.List[gr.components.Component],
         outputs: typing.List[gr.components.Component],
+        afn: typing.Optional[typing.Callable[..., typing.Awaitable]] = None,
     ) -> None:
         self.fn = fn
+        self.afn = afn
         self.inputs = inputs
         self.outputs = outputs
 
+    async def acall(self, *args, **kwargs):
+        # Models without a native async implementation run on a worker thread.
+        if self.afn is not None:
+            return await self.afn(*args, **kwargs)
+        return await asyncio.to_thread(self.fn, *args, **kwargs)
+
+    async def acall_stream(self, *args, **kwargs) -> typing.AsyncIterator:
+        # Async generators are consumed directly; blocking iterators are
+        # advanced one item at a time on a worker thread.
+        stream = await self.acall(*args, stream=True, **kwargs)
+        if hasattr(stream, "__aiter__"):
+            async for item in stream:
+                yield item
+        else:
+            async for item in aiter_in_thread(stream):
+                yield item
+
     def prompt(*args, **kwargs) -> str:
         return
+
+async def aiter_of(items: typing.Iterable) -> typing.AsyncIterator:
+    for item in items:
+        yield item
+
+async def aiter_in_thread(items: typing.Iterable) -> typing.AsyncIterator:
+    iterator = iter(items)
+    done = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+_shared_models: typing.Dict[tuple, Model] = {}
+_shared_models_lock = threading.Lock()
+
+def get_shared_model(
+    model_class: typing.Type[Model],
+    **kwargs,
+) -> Model:
+    # Stateless models (API clients, encoders) are created once per process
+    # and shared by every session; per-session state must live elsewhere.
+    key = (model_class, tuple(sorted(kwargs.items())))
+    model = _shared_models.get(key)
+    if model is None:
+        with _shared_models_lock:
+            model = _shared_models.get(key)
+            if model is None:
+                model = model_class(**kwargs)
+                _shared_models[key] = model
+    return model
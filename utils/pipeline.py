@@ -1,41 +1,241 @@
+import asyncio
+import gradio as gr
+import hashlib
+import os
+import re
+import tempfile
+import time
+import threading
+import typing
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, wait
+from queue import Empty, Queue
 from utils.model import Model
-from conversation.prompter import BasePrompter, AugmentedPrompter
+from utils.limits import ConcurrencyLimit
+from conversation.prompter import BasePrompter, AugmentedPrompter, Turn, ERROR_RESPONSE
+
+# Sentences of a streamed reply are synthesized on this pool while generation continues.
+_speech_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speech")
+_sentence_boundary = re.compile(r"[.!?\n][\"')\]]*\s")
+# Synthesized MP3s are stored by content, so repeated sentences reuse their file.
+_speech_dir = os.path.join(tempfile.gettempdir(), "maia-speech")
 
 class Pipeline(Model):
     def __init__(
         self,
         transcribe_model: Model,
         generate_model: Model,
-        #synthesize_model: Model,
+        synthesize_model: Model = None,
         forced_response: str = "",
+        stream: bool = False,
+        asr_limit: ConcurrencyLimit = None,
+        llm_limit: ConcurrencyLimit = None,
     ):
+        self.transcribe_model = transcribe_model
+        self.generate_model = generate_model
+        self.synthesize_model = synthesize_model
+        # Shared by all sessions created from this pipeline.
+        self.asr_limit = asr_limit or ConcurrencyLimit("asr")
+        self.llm_limit = llm_limit or ConcurrencyLimit("llm")
+
         self.transcribe = transcribe_model.fn
         self.generate = generate_model.fn
-        #self.synthesize = synthesize_model.fn
+        self.synthesize = synthesize_model.fn if synthesize_model else None
         self.forced_response = forced_response
+        self.stream_output = stream
+
+        if forced_response and hasattr(synthesize_model, "prewarm"):
+            synthesize_model.prewarm([forced_response])
 
         self.setup_interface(
-            fn=self,
+            fn=self.stream if stream else self,
+            afn=self.astream if stream else self.arun,
             inputs=transcribe_model.inputs,
             outputs=[
                 *transcribe_model.outputs,
                 *generate_model.outputs,
-                #*synthesize_model.outputs,
+                *([self.__speech_output(stream)] if synthesize_model else []),
             ],
         )
     
     def __call__(self, *args, **kwargs):
-        transcript = self.transcribe(*args, **kwargs)
+        with self.asr_limit:
+            transcript = self.transcribe(*args, **kwargs)
 
         if self.forced_response:
             message = self.forced_response
         else:
-            message = "".join(self.generate(transcript))
+            with self.llm_limit:
+                message = "".join(self.generate(transcript))
+
+        if self.synthesize:
+            return transcript, message, self.__synthesize_file(message)
+        return transcript, message
+
+    async def arun(self, *args, **kwargs):
+        async with self.asr_limit:
+            transcript = await self.transcribe_model.acall(*args, **kwargs)
 
-        #speech = self.synthesize(message)
+        if self.forced_response:
+            message = self.forced_response
+        else:
+            async with self.llm_limit:
+                message = "".join(await self.generate_model.acall(transcript))
 
+        if self.synthesize:
+            return transcript, message, await self.__asynthesize_file(message)
         return transcript, message
 
+    def create_session(self) -> "Pipeline":
+        # Shares the transcription model; only the conversation state is per session.
+        generate_model = self.generate_model
+        if hasattr(generate_model, "create_session"):
+            generate_model = generate_model.create_session()
+
+        return Pipeline(
+            transcribe_model=self.transcribe_model,
+            generate_model=generate_model,
+            synthesize_model=self.synthesize_model,
+            forced_response=self.forced_response,
+            stream=self.stream_output,
+            asr_limit=self.asr_limit,
+            llm_limit=self.llm_limit,
+        )
+
+    def stream(self, *args, **kwargs):
+        # Yields the outputs with the message growing as tokens arrive. With a
+        # synthesize model, each complete sentence is synthesized while the rest
+        # is generated; the speech output streams the audio chunks in sentence
+        # order, and the client plays each one after the previous has finished.
+        with self.asr_limit:
+            transcript = self.transcribe(*args, **kwargs)
+
+        if self.forced_response:
+            yield self.__outputs(transcript, self.forced_response)
+            if self.synthesize:
+                yield self.__outputs(transcript, self.forced_response, self.__synthesize_file(self.forced_response))
+            return
+
+        message = ""
+        spoken = 0
+        speech = deque()
+        submit = lambda text: _speech_executor.submit(self.__synthesize_file, text)
+
+        yield self.__outputs(transcript, message)
+        with self.llm_limit:
+            for token in self.generate(transcript, stream=True):
+                message += token
+                if self.synthesize:
+                    spoken = self.__speak(message, spoken, speech, submit)
+                yield self.__outputs(transcript, message, self.__next_speech(speech))
+
+        if self.synthesize:
+            self.__speak(message, spoken, speech, submit, final=True)
+        while speech:
+            wait([speech[0]])
+            yield self.__outputs(transcript, message, self.__next_speech(speech))
+
+    async def astream(self, *args, **kwargs):
+        async with self.asr_limit:
+            transcript = await self.transcribe_model.acall(*args, **kwargs)
+
+        if self.forced_response:
+            yield self.__outputs(transcript, self.forced_response)
+            if self.synthesize:
+                yield self.__outputs(transcript, self.forced_response, await self.__asynthesize_file(self.forced_response))
+            return
+
+        message = ""
+        spoken = 0
+        speech = deque()
+        submit = lambda text: asyncio.create_task(self.__asynthesize_file(text))
+
+        yield self.__outputs(transcript, message)
+        try:
+            async with self.llm_limit:
+                async for token in self.generate_model.acall_stream(transcript):
+                    message += token
+                    if self.synthesize:
+                        spoken = self.__speak(message, spoken, speech, submit)
+                    yield self.__outputs(transcript, message, self.__next_speech(speech))
+
+            if self.synthesize:
+                self.__speak(message, spoken, speech, submit, final=True)
+            while speech:
+                await asyncio.wait([speech[0]])
+                yield self.__outputs(transcript, message, self.__next_speech(speech))
+        finally:
+            for task in speech:
+                task.cancel()
+
+    def __outputs(
+        self,
+        transcript: str,
+        message: str,
+        speech: typing.Optional[str] = None,
+    ) -> tuple:
+        if self.synthesize:
+            # The speech output is streaming: None adds no chunk, a path appends one.
+            return transcript, message, speech
+        return transcript, message
+
+    @staticmethod
+    def __speech_output(stream: bool) -> gr.components.Audio:
+        return gr.components.Audio(
+            label="Speech",
+            type="filepath",
+            streaming=stream,
+            autoplay=True,
+        )
+
+    def __synthesize_file(self, text: str) -> str:
+        return self.__write_speech(self.synthesize(text, output_format="bytes"))
+
+    async def __asynthesize_file(self, text: str) -> str:
+        return self.__write_speech(await self.synthesize_model.acall(text, output_format="bytes"))
+
+    @staticmethod
+    def __write_speech(audio: bytes) -> str:
+        os.makedirs(_speech_dir, exist_ok=True)
+        path = os.path.join(_speech_dir, f"{hashlib.sha1(audio).hexdigest()}.mp3")
+        if not os.path.exists(path):
+            # Written aside and renamed, so a concurrent reader never sees a partial file.
+            fd, partial = tempfile.mkstemp(dir=_speech_dir, suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                f.write(audio)
+            os.replace(partial, path)
+        return path
+
+    @staticmethod
+    def __speak(
+        message: str,
+        spoken: int,
+        speech: deque,
+        submit: typing.Callable[[str], typing.Union[Future, asyncio.Task]],
+        final: bool = False,
+    ) -> int:
+        # Submits the text up to the last sentence boundary not yet spoken.
+        end = len(message)
+        if not final:
+            boundaries = list(_sentence_boundary.finditer(message, spoken))
+            end = boundaries[-1].end() if boundaries else spoken
+
+        text = message[spoken:end].strip()
+        if text:
+            speech.append(submit(text))
+        return end
+
+    @staticmethod
+    def __next_speech(speech: deque) -> typing.Optional[str]:
+        if not speech or not speech[0].done():
+            return None
+
+        try:
+            return speech.popleft().result()
+        except Exception as e:
+            print(f"Speech synthesis failed with error: {e}")
+            return None
+
 class PairwisePipeline(Pipeline):
     def __init__(
         self,
@@ -43,8 +243,16 @@ class PairwisePipeline(Pipeline):
         generate_model_1: BasePrompter,
         generate_model_2: AugmentedPrompter,
         forced_response: str = "",
+        concurrent: bool = True,
+        arm_timeout: typing.Optional[float] = None,
+        stream: bool = False,
+        asr_limit: ConcurrencyLimit = None,
+        llm_limit: ConcurrencyLimit = None,
     ):
         self.transcribe_model = transcribe_model
+        # Shared by all sessions created from this pipeline.
+        self.asr_limit = asr_limit or ConcurrencyLimit("asr")
+        self.llm_limit = llm_limit or ConcurrencyLimit("llm")
         self.generate_model_1 = generate_model_1
         self.generate_model_2 = generate_model_2
 
@@ -53,9 +261,13 @@ class PairwisePipeline(Pipeline):
         self.generate_2 = generate_model_2.fn
 
         self.forced_response = forced_response
+        self.concurrent = concurrent
+        self.arm_timeout = arm_timeout
+        self.stream_output = stream
 
         self.setup_interface(
-            fn=self,
+            fn=self.stream if stream else self,
+            afn=self.astream if stream else self.arun,
             inputs=transcribe_model.inputs,
             outputs=[
                 *transcribe_model.outputs,
@@ -65,17 +277,229 @@ class PairwisePipeline(Pipeline):
         )
     
     def __call__(self, *args, **kwargs):
-        transcript = self.transcribe(*args, **kwargs)
+        with self.asr_limit:
+            transcript = self.transcribe(*args, **kwargs)
 
         if self.forced_response:
             message1 = message2 = self.forced_response
         else:
-            if not self.generate_model_1.model_loaded:
-                self.generate_model_1.reset()
-            if not self.generate_model_2.model_loaded:
-                self.generate_model_2.reset()
+            self.__load_models()
+            turns = self.__begin_turns()
 
-            message1 = "".join(self.generate_1(transcript))
-            message2 = "".join(self.generate_2(transcript))
+            if self.concurrent:
+                message1, message2 = self.__generate_concurrently(transcript, turns)
+            else:
+                message1 = self.__generate(self.generate_1, transcript, turns[0])
+                message2 = self.__generate(self.generate_2, transcript, turns[1])
 
         return transcript, message1, message2
+
+    async def arun(self, *args, **kwargs):
+        async with self.asr_limit:
+            transcript = await self.transcribe_model.acall(*args, **kwargs)
+
+        if self.forced_response:
+            return transcript, self.forced_response, self.forced_response
+
+        await asyncio.to_thread(self.__load_models)
+        turns = self.__begin_turns()
+
+        async def generate(index: int, model: Model) -> str:
+            try:
+                async with self.llm_limit:
+                    return "".join(await asyncio.wait_for(model.acall(transcript, turn=turns[index]), self.arm_timeout))
+            except asyncio.TimeoutError:
+                print(f"Model {index+1} timed out after {self.arm_timeout} seconds")
+                turns[index].abandon()
+            except Exception as e:
+                print(f"Model {index+1} failed with error: {e}")
+            return ERROR_RESPONSE
+
+        if self.concurrent:
+            message1, message2 = await asyncio.gather(
+                generate(0, self.generate_model_1),
+                generate(1, self.generate_model_2),
+            )
+        else:
+            message1 = await generate(0, self.generate_model_1)
+            message2 = await generate(1, self.generate_model_2)
+
+        return transcript, message1, message2
+
+    def create_session(self) -> "PairwisePipeline":
+        # Shares the transcription model; only the conversation state is per session.
+        return PairwisePipeline(
+            transcribe_model=self.transcribe_model,
+            generate_model_1=self.generate_model_1.create_session(),
+            generate_model_2=self.generate_model_2.create_session(),
+            forced_response=self.forced_response,
+            concurrent=self.concurrent,
+            arm_timeout=self.arm_timeout,
+            stream=self.stream_output,
+            asr_limit=self.asr_limit,
+            llm_limit=self.llm_limit,
+        )
+
+    def __generate_concurrently(
+        self,
+        transcript: str,
+        turns: list[Turn],
+    ) -> tuple[str, str]:
+        # Each arm runs in its own thread; a failing or slow arm falls back
+        # to the error response without holding up the other one.
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pairwise")
+        futures = [
+            executor.submit(self.__generate, self.generate_1, transcript, turns[0]),
+            executor.submit(self.__generate, self.generate_2, transcript, turns[1]),
+        ]
+        executor.shutdown(wait=False)
+
+        deadline = None if self.arm_timeout is None else time.monotonic() + self.arm_timeout
+        messages = []
+        for index, future in enumerate(futures):
+            try:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                messages.append(future.result(timeout=timeout))
+            except TimeoutError:
+                print(f"Model {index+1} timed out after {self.arm_timeout} seconds")
+                turns[index].abandon()
+                messages.append(ERROR_RESPONSE)
+            except Exception as e:
+                print(f"Model {index+1} failed with error: {e}")
+                messages.append(ERROR_RESPONSE)
+        return messages[0], messages[1]
+
+    def __generate(
+        self,
+        generate: typing.Callable,
+        transcript: str,
+        turn: Turn,
+    ) -> str:
+        with self.llm_limit:
+            return "".join(generate(transcript, turn=turn))
+
+    def stream(self, *args, **kwargs):
+        # Both arms stream concurrently; each yield carries the latest text of both.
+        with self.asr_limit:
+            transcript = self.transcribe(*args, **kwargs)
+
+        if self.forced_response:
+            yield transcript, self.forced_response, self.forced_response
+            return
+
+        self.__load_models()
+        turns = self.__begin_turns()
+
+        messages = ["", ""]
+        yield transcript, *messages
+
+        queue = Queue()
+        def run(index: int, generate: typing.Callable) -> None:
+            try:
+                with self.llm_limit:
+                    for token in generate(transcript, stream=True, turn=turns[index]):
+                        queue.put((index, token))
+            except Exception as e:
+                print(f"Model {index+1} failed with error: {e}")
+                queue.put((index, e))
+            queue.put((index, None))
+
+        for index, generate in enumerate([self.generate_1, self.generate_2]):
+            threading.Thread(target=run, args=(index, generate), daemon=True).start()
+
+        deadline = None if self.arm_timeout is None else time.monotonic() + self.arm_timeout
+        running = {0, 1}
+        while running:
+            try:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                index, token = queue.get(timeout=timeout)
+            except Empty:
+                for index in running:
+                    print(f"Model {index+1} timed out after {self.arm_timeout} seconds")
+                    turns[index].abandon()
+                    messages[index] = ERROR_RESPONSE
+                yield transcript, *messages
+                return
+
+            if index not in running:
+                continue
+            if token is None:
+                running.discard(index)
+                continue
+            if isinstance(token, Exception):
+                messages[index] = ERROR_RESPONSE
+            else:
+                messages[index] += token
+            yield transcript, *messages
+
+    async def astream(self, *args, **kwargs):
+        # Same protocol as stream(), with both arms as tasks on the event loop.
+        async with self.asr_limit:
+            transcript = await self.transcribe_model.acall(*args, **kwargs)
+
+        if self.forced_response:
+            yield transcript, self.forced_response, self.forced_response
+            return
+
+        await asyncio.to_thread(self.__load_models)
+        turns = self.__begin_turns()
+
+        messages = ["", ""]
+        yield transcript, *messages
+
+        queue = asyncio.Queue()
+        async def run(index: int, model: Model) -> None:
+            try:
+                async with self.llm_limit:
+                    async for token in model.acall_stream(transcript, turn=turns[index]):
+                        queue.put_nowait((index, token))
+            except Exception as e:
+                print(f"Model {index+1} failed with error: {e}")
+                queue.put_nowait((index, e))
+            queue.put_nowait((index, None))
+
+        tasks = [
+            asyncio.create_task(run(index, model))
+            for index, model in enumerate([self.generate_model_1, self.generate_model_2])
+        ]
+
+        deadline = None if self.arm_timeout is None else time.monotonic() + self.arm_timeout
+        running = {0, 1}
+        try:
+            while running:
+                try:
+                    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                    index, token = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    for index in running:
+                        print(f"Model {index+1} timed out after {self.arm_timeout} seconds")
+                        turns[index].abandon()
+                        messages[index] = ERROR_RESPONSE
+                    yield transcript, *messages
+                    return
+
+                if index not in running:
+                    continue
+                if token is None:
+                    running.discard(index)
+                    continue
+                if isinstance(token, Exception):
+                    messages[index] = ERROR_RESPONSE
+                else:
+                    messages[index] += token
+                yield transcript, *messages
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def __begin_turns(self) -> list[Turn]:
+        # Starting a turn fences off an arm still running from the previous one.
+        # An arm that times out keeps running in the background, but abandoning
+        # its turn keeps the reply the user never saw out of the session.
+        return [self.generate_model_1.begin_turn(), self.generate_model_2.begin_turn()]
+
+    def __load_models(self) -> None:
+        if not self.generate_model_1.model_loaded:
+            self.generate_model_1.reset()
+        if not self.generate_model_2.model_loaded:
+            self.generate_model_2.reset()